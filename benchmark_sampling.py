@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import subprocess
+import numpy as np
+
+# Throughput benchmarks of the data path (generate_data.py) on a fixed
+# synthetic data set. Every case runs in its own process, so peak RSS is the
+# memory of that case alone (without sampling worker processes). Results are
+# written as JSON, given a baseline from an earlier run, cases that got
+# slower are reported.
+#
+#   python benchmark_sampling.py results.json [baseline.json]
+#
+# The data sets are generated on the first run into BENCHMARK_DATA (default
+# ./benchmark_data/) and reused afterwards, so are the sampler caches and
+# the chunked test volume.
+
+data_shape = (20, 1024, 1024)
+
+# a case is timed for at least this many seconds, with at most max_repeats calls
+min_seconds = 1.0
+max_repeats = 5
+# relative slowdown against the baseline that counts as a regression
+tolerance = 0.2
+
+
+def benchmark_data_path():
+    return os.path.join(os.environ.get('BENCHMARK_DATA', './benchmark_data/'), '')
+
+
+def prepare_data():
+    # the fixed training and test data sets, written once with fixed seeds
+    import synthetic_data
+    path = benchmark_data_path()
+    if not os.path.exists(path + 'complete'):
+        synthetic_data.write_training_data(path + 'training/', shape=data_shape, seed=0)
+        open(path + 'complete', 'w').close()
+    if not os.path.exists(path + 'testing_complete'):
+        synthetic_data.write_test_data(path + 'testing/', shape=data_shape, seed=100)
+        open(path + 'testing_complete', 'w').close()
+    return path
+
+
+def test_volume_path(path):
+    # the chunked test volume of the benchmark, kept apart from
+    # testing/volume/ so the tif cases still read the tif images
+    return path + 'test_volume/'
+
+
+def sampler_case(function, **params):
+    return dict(params, function=function)
+
+
+def benchmark_cases():
+    cases = []
+
+    # patch prediction over patch and output sizes, purposes and layers
+    for patchSize, outPatchSize, nsamples in ((29, 1, 20000), (65, 1, 5000), (65, 33, 5000), (572, 388, 20)):
+        for purpose in ('train', 'validate'):
+            cases.append(sampler_case('generate_experiment_data_patch_prediction', purpose=purpose,
+                                      nsamples=nsamples, patchSize=patchSize, outPatchSize=outPatchSize))
+        for nr_layers in (3, 5):
+            cases.append(sampler_case('generate_experiment_data_patch_prediction_layers', purpose='train',
+                                      nsamples=nsamples, patchSize=patchSize, outPatchSize=outPatchSize,
+                                      nr_layers=nr_layers))
+    # small and large requests, e.g. single minibatches against whole epochs
+    for nsamples in (100, 1000, 100000):
+        cases.append(sampler_case('generate_experiment_data_patch_prediction', purpose='train',
+                                  nsamples=nsamples, patchSize=29, outPatchSize=1))
+
+    # supervised patches are centered on a pixel, so their size is odd
+    for patchSize, nsamples in ((29, 20000), (65, 5000)):
+        cases.append(sampler_case('generate_experiment_data_supervised', purpose='train',
+                                  nsamples=nsamples, patchSize=patchSize))
+
+    # minibatches as the training scripts draw them, with sampling workers
+    for nr_workers in (0, 1, 2, 4):
+        cases.append(sampler_case('minibatch_generator', purpose='train', batch_size=100, nr_batches=50,
+                                  patchSize=29, nr_workers=nr_workers))
+
+    # inference tiles of all test images as the unet loops read them, from
+    # the tif images and from the chunked test volume
+    for source in ('tif', 'chunked'):
+        for nr_layers in (1, 3):
+            cases.append(sampler_case('test_tiles', source=source, patchSize=572, patchSize_out=388,
+                                      nr_layers=nr_layers))
+
+    # inference patches and the standalone helpers
+    for patchSize in (29, 65):
+        cases.append(sampler_case('generate_image_data', patchSize=patchSize, rows=16))
+    cases.append(sampler_case('normalizeImage'))
+    cases.append(sampler_case('adjust_imprecise_boundaries', number_iterations=5))
+    for patchSize in (29, 65, 572):
+        cases.append(sampler_case('deform_images', patchSize=patchSize, nr_patches=100))
+    return cases
+
+
+def case_call(case, path):
+    '''(call, items) for a case, call() runs it once and produces items
+    patches (or images for the whole image helpers).
+
+    '''
+    import generate_data
+    import minibatches
+    import chunked_volume
+    import mahotas
+    rng = np.random.RandomState(0)
+    function = case['function']
+    params = dict((key, value) for key, value in case.items() if key != 'function')
+
+    if function.startswith('generate_experiment_data'):
+        sample = getattr(generate_data, function)
+        return lambda: sample(rng=rng, **params), case['nsamples']
+
+    if function == 'minibatch_generator':
+        batches = minibatches.minibatch_generator(generate_data.generate_experiment_data_patch_prediction,
+                                                  case['purpose'], case['batch_size'], args=(case['patchSize'], 1),
+                                                  input_shape=(1, case['patchSize'], case['patchSize']),
+                                                  nr_workers=case['nr_workers'])
+        def draw_batches():
+            for batch in xrange(case['nr_batches']):
+                next(batches)
+        return draw_batches, case['batch_size']*case['nr_batches']
+
+    if function == 'test_tiles':
+        volume_path = None
+        if case['source'] == 'chunked':
+            volume_path = test_volume_path(path)
+            if not chunked_volume.is_volume(volume_path):
+                generate_data.convert_test_volume(path + 'testing/', volume_path)
+        def read_tiles():
+            # opened on every call, so every slice (or chunk) is read again
+            test_images = generate_data.TestImages(path + 'testing/', volume_path=volume_path)
+            padding_ul = (case['patchSize'] - case['patchSize_out'] + 1) // 2
+            nr_images = len(test_images.names)
+            for img_index in xrange(nr_images):
+                layers = np.clip(np.arange(case['nr_layers']) + img_index - case['nr_layers'] // 2, 0, nr_images - 1)
+                for row in xrange(0, test_images.shape[0], case['patchSize_out']):
+                    for col in xrange(0, test_images.shape[1], case['patchSize_out']):
+                        test_images.tile(layers, row - padding_ul, col - padding_ul, case['patchSize'])
+        tiles_per_image = len(xrange(0, data_shape[1], case['patchSize_out'])) * len(xrange(0, data_shape[2], case['patchSize_out']))
+        return read_tiles, data_shape[0] * tiles_per_image
+
+    image = mahotas.imread(path + 'training/images/train/train_0000.tif')
+    membranes = mahotas.imread(path + 'training/labels/membranes_fullContour/train/train_0000.tif') > 0
+    if function == 'generate_image_data':
+        rows = np.arange(case['rows'])
+        return lambda: generate_data.generate_image_data(image, case['patchSize'], rows), case['rows']*image.shape[1]
+    if function == 'normalizeImage':
+        return lambda: generate_data.normalizeImage(image), 1
+    if function == 'adjust_imprecise_boundaries':
+        normalized = generate_data.read_normalized_image(path + 'training/images/train/train_0000.tif')
+        return lambda: generate_data.adjust_imprecise_boundaries(normalized, membranes, case['number_iterations']), 1
+    if function == 'deform_images':
+        size = case['patchSize']
+        corners = rng.randint(image.shape[0] - size, size=(case['nr_patches'], 2))
+        patches = [(image[row:row+size, col:col+size], membranes[row:row+size, col:col+size]) for row, col in corners]
+        def deform_patches():
+            for image_patch, membrane_patch in patches:
+                generate_data.deform_images(image_patch, membrane_patch, rng=rng)
+        return deform_patches, case['nr_patches']
+    raise ValueError('unknown benchmark ' + function)
+
+
+def run_case(case):
+    # runs in the process of the case, the first call includes the setup
+    # (caches, displacement banks, workers) and is timed on its own
+    path = prepare_data()
+    os.environ['DATA_PATH'] = path + 'training/'
+    os.environ.setdefault('VOLUME_CACHE_DIR', path + 'volume_cache/')
+
+    start = time.time()
+    call, items = case_call(case, path)
+    call()
+    setup_seconds = time.time() - start
+
+    times = []
+    while len(times) < max_repeats and sum(times) < min_seconds:
+        start = time.time()
+        call()
+        times.append(time.time() - start)
+    seconds = float(np.median(times))
+
+    # ru_maxrss is in kilobytes on Linux
+    return {'case': case, 'items': items, 'seconds': seconds, 'items_per_second': items / seconds,
+            'setup_seconds': setup_seconds, 'repeats': len(times),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+
+
+def case_name(case):
+    return json.dumps(case, sort_keys=True)
+
+
+def run_benchmarks(cases):
+    prepare_data()
+    results = []
+    for case in cases:
+        # the case writes its result to a file, the sampler output (also of
+        # sampling workers) is dropped
+        result_file = tempfile.NamedTemporaryFile(suffix='.json')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case), result_file.name],
+                                  stdout=devnull)
+        result = json.load(result_file)
+        result_file.close()
+        print '%-100s %12.1f/s %8.1f MB' % (case_name(case), result['items_per_second'], result['peak_rss_mb'])
+        results.append(result)
+    return results
+
+
+def regressions(results, baseline):
+    # cases that are more than tolerance slower than in the baseline
+    baseline = dict((case_name(result['case']), result) for result in baseline)
+    slower = []
+    for result in results:
+        before = baseline.get(case_name(result['case']))
+        if before is not None and result['items_per_second'] < (1 - tolerance) * before['items_per_second']:
+            slower.append((result['case'], before['items_per_second'], result['items_per_second']))
+    return slower
+
+
+if __name__=="__main__":
+    if sys.argv[1] == '--case':
+        result = run_case(json.loads(sys.argv[2]))
+        with open(sys.argv[3], 'w') as result_file:
+            json.dump(result, result_file)
+        sys.exit(0)
+
+    results = run_benchmarks(benchmark_cases())
+    with open(sys.argv[1], 'w') as results_file:
+        json.dump(results, results_file, indent=1, sort_keys=True)
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as baseline_file:
+            slower = regressions(results, json.load(baseline_file))
+        for case, before, after in slower:
+            print 'REGRESSION', case_name(case), '%.1f/s -> %.1f/s' % (before, after)
+        if slower:
+            sys.exit(1)
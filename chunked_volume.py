@@ -0,0 +1,169 @@
+import os
+import json
+import zlib
+import itertools
+import collections
+import numpy as np
+from tracing import span
+
+# bump whenever the on-disk layout changes
+VOLUME_VERSION = 1
+
+
+def chunk_file(path, channel, chunk_index, compress):
+    name = '_'.join(str(index) for index in chunk_index)
+    return os.path.join(path, channel, name + ('.z' if compress else '.npy'))
+
+
+def write_volume(path, channels, nr_slices, chunk_shape=(1, 256, 256), compress=False, file_names=None,
+                 attributes=None):
+    '''Writes a chunked volume to the directory path.
+
+    channels maps a channel name (e.g. 'gray', 'membranes') to a function
+    read_slice(z) that returns slice z of that channel as a 2d array. All
+    channels have the same shape. The volume is cut into chunks of
+    chunk_shape (z, y, x), every chunk is one file, zlib compressed if
+    compress is set. Slices are read chunk_shape[0] at a time, so memory
+    stays bounded by one row of chunks. file_names (e.g. the source images)
+    are stored in the index so slices can be selected by name later,
+    attributes (anything json can store) are kept in the index as well.
+
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    index = {'version': VOLUME_VERSION, 'chunk_shape': list(chunk_shape),
+             'compress': compress, 'file_names': file_names, 'attributes': attributes or {}, 'channels': {}}
+    for channel, read_slice in sorted(channels.items()):
+        if not os.path.exists(os.path.join(path, channel)):
+            os.makedirs(os.path.join(path, channel))
+
+        for z_start in xrange(0, nr_slices, chunk_shape[0]):
+            block = np.array([read_slice(z) for z in xrange(z_start, min(z_start + chunk_shape[0], nr_slices))])
+            for y_start in xrange(0, block.shape[1], chunk_shape[1]):
+                for x_start in xrange(0, block.shape[2], chunk_shape[2]):
+                    chunk = np.ascontiguousarray(block[:, y_start:y_start + chunk_shape[1], x_start:x_start + chunk_shape[2]])
+                    chunk_index = (z_start // chunk_shape[0], y_start // chunk_shape[1], x_start // chunk_shape[2])
+                    with open(chunk_file(path, channel, chunk_index, compress), 'wb') as out_file:
+                        if compress:
+                            out_file.write(zlib.compress(chunk.tobytes(), 1))
+                        else:
+                            np.save(out_file, chunk)
+
+        index['shape'] = [nr_slices, block.shape[1], block.shape[2]]
+        index['channels'][channel] = {'dtype': block.dtype.str}
+
+    # the index is written last, a volume without one is incomplete
+    tmp_path = os.path.join(path, 'index.json.' + str(os.getpid()) + '.tmp')
+    with open(tmp_path, 'w') as index_file:
+        json.dump(index, index_file)
+    os.rename(tmp_path, os.path.join(path, 'index.json'))
+
+
+def is_volume(path):
+    return os.path.exists(os.path.join(path, 'index.json'))
+
+
+class ChunkedVolume(object):
+    '''Random access reader for volumes written by write_volume.
+
+    read(channel, z, y, x) returns any window of a channel and only loads
+    the chunks the window overlaps. The cache_size most recently used
+    chunks are kept in memory.
+
+    '''
+    def __init__(self, path, cache_size=64):
+        with open(os.path.join(path, 'index.json')) as index_file:
+            index = json.load(index_file)
+        if index['version'] != VOLUME_VERSION:
+            raise ValueError('unsupported volume version ' + str(index['version']) + ' in ' + path)
+
+        self.path = path
+        self.shape = tuple(index['shape'])
+        self.chunk_shape = tuple(index['chunk_shape'])
+        self.compress = index['compress']
+        self.file_names = index['file_names']
+        self.attributes = index.get('attributes', {})
+        self.dtypes = dict((channel, np.dtype(str(description['dtype'])))
+                           for channel, description in index['channels'].items())
+        self.channels = sorted(self.dtypes.keys())
+        self.cache_size = cache_size
+        self.chunks = collections.OrderedDict()
+
+    def chunk(self, channel, chunk_index):
+        key = (channel, chunk_index)
+        if key in self.chunks:
+            chunk = self.chunks.pop(key)
+        else:
+            with span('read', channel=channel, chunk=list(chunk_index)):
+                chunk = self.load_chunk(channel, chunk_index)
+        self.chunks[key] = chunk
+        if len(self.chunks) > self.cache_size:
+            self.chunks.popitem(last=False)
+        return chunk
+
+    def load_chunk(self, channel, chunk_index):
+        # the chunk as it is stored, without the cache
+        file_name = chunk_file(self.path, channel, chunk_index, self.compress)
+        if self.compress:
+            shape = [min(size, total - index*size) for index, size, total
+                     in zip(chunk_index, self.chunk_shape, self.shape)]
+            with open(file_name, 'rb') as in_file:
+                return np.frombuffer(zlib.decompress(in_file.read()), dtype=self.dtypes[channel]).reshape(shape)
+        return np.load(file_name)
+
+    def read(self, channel, z, y=slice(None), x=slice(None)):
+        # z, y and x are integers or slices without step, like numpy indexing
+        # volume[z, y, x]. Windows reaching outside the volume are an error.
+        window = []
+        squeeze = []
+        for axis, index in enumerate((z, y, x)):
+            if isinstance(index, slice):
+                start, stop, step = index.indices(self.shape[axis])
+                if step != 1:
+                    raise ValueError('volume windows can not have a step')
+            else:
+                start, stop = int(index), int(index) + 1
+                squeeze.append(axis)
+            if start < 0 or stop > self.shape[axis] or stop < start:
+                raise IndexError('window outside of the volume')
+            window.append((start, stop))
+
+        out = np.empty([stop - start for start, stop in window], dtype=self.dtypes[channel])
+        chunk_ranges = [xrange(start // size, (stop - 1) // size + 1) if stop > start else []
+                        for (start, stop), size in zip(window, self.chunk_shape)]
+        for chunk_index in itertools.product(*chunk_ranges):
+            chunk = self.chunk(channel, chunk_index)
+            source = []
+            target = []
+            for (start, stop), index, size in zip(window, chunk_index, self.chunk_shape):
+                chunk_start = index*size
+                low = max(start, chunk_start)
+                high = min(stop, chunk_start + size)
+                source.append(slice(low - chunk_start, high - chunk_start))
+                target.append(slice(low - start, high - start))
+            out[tuple(target)] = chunk[tuple(source)]
+
+        return out.reshape([size for axis, size in enumerate(out.shape) if axis not in squeeze])
+
+
+class VolumeWindow(object):
+    '''One channel of a ChunkedVolume at slice z, cut like a 2d array.
+
+    window[rows, cols] reads only that window. With a list of slices for z,
+    window[rows, cols] is a C-contiguous (len(z), rows, cols) block.
+
+    '''
+    def __init__(self, volume, channel, z):
+        self.volume = volume
+        self.channel = channel
+        self.z = z
+        self.shape = volume.shape[1:]
+        if not np.isscalar(z):
+            self.shape = (len(z),) + self.shape
+
+    def __getitem__(self, key):
+        rows, cols = key[-2:]
+        if np.isscalar(self.z):
+            return self.volume.read(self.channel, self.z, rows, cols)
+        return np.array([self.volume.read(self.channel, z, rows, cols) for z in self.z])
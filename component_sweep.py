@@ -0,0 +1,80 @@
+import numpy as np
+import scipy.ndimage
+from contingency import count_pairs
+
+# Connected components of a probability map thresholded at many levels.
+# Thresholded regions are nested, a lower threshold only adds pixels and
+# merges components, so every component of a higher threshold lies in
+# exactly one component of the next lower one. Each threshold is still
+# labelled on its own with scipy.ndimage.label (a two-pass labelling in C,
+# several times faster than mahotas.label), so the labelling costs one pass
+# over the image per threshold. Only the per-component state, e.g. the
+# counts of ground truth values, is carried from one threshold to the next,
+# through one representative pixel per component.
+
+
+def threshold_levels(probabilities, thresholds):
+    # number of thresholds a pixel is above, a pixel is foreground at
+    # threshold thresholds[i] (sorted) if its level is larger than i
+    return np.searchsorted(np.sort(thresholds), probabilities.ravel(), side='left')
+
+
+def component_sweep(probabilities, thresholds, values=None):
+    '''Connected components of probabilities > t for every threshold t.
+
+    Yields (index, labels, nr_labels, table) from the highest threshold to
+    the lowest, index is the position of the threshold in thresholds. labels
+    is exactly mahotas.label(probabilities > thresholds[index]): components
+    of 4-connected (in 2d) pixels numbered from 1 in raster order of their
+    first pixel, 0 for the background.
+
+    values (non-negative integers, e.g. ground truth ids, -1 to leave a
+    pixel out) are counted per component while components merge. table is
+    (labels, values, counts) of all (component, value) pairs of foreground
+    pixels, so contingency tables never have to be recounted from the
+    pixels. Besides labelling the whole image, the work per threshold is the
+    pixels it adds plus the current components and table entries.
+
+    '''
+    shape = probabilities.shape
+    thresholds = np.asarray(thresholds)
+    levels = threshold_levels(probabilities, thresholds)
+    # pixels from the highest level down, in raster order within a level
+    # (a counting sort), the foreground of the i-th lowest threshold is the
+    # prefix of order up to ends[i]
+    order = np.concatenate([np.flatnonzero(levels == level) for level in xrange(len(thresholds), -1, -1)])
+    ends = np.cumsum(np.bincount(levels, minlength=len(thresholds) + 1)[::-1])[::-1][1:]
+    levels = levels.reshape(shape)
+
+    if values is not None:
+        values = np.asarray(values).ravel()
+    table_components = np.zeros(0, dtype=np.int64)
+    table_values = np.zeros(0, dtype=np.int64)
+    table_counts = np.zeros(0, dtype=np.int64)
+
+    # one pixel of every component of the threshold before
+    representatives = np.zeros(0, dtype=np.int64)
+    start = 0
+    for level, index in reversed(list(enumerate(np.argsort(thresholds, kind='mergesort')))):
+        end = ends[level]
+        added = order[start:end]
+        labels, nr_components = scipy.ndimage.label(levels > level)
+        labels = labels.astype(np.int32, copy=False)
+
+        # the component every old component and added pixel ended up in
+        merged = labels.flat[representatives] - 1
+        added_components = labels.flat[added] - 1
+        old_representatives = representatives
+        representatives = np.empty(nr_components, dtype=np.int64)
+        representatives[merged] = old_representatives
+        representatives[added_components] = added
+        start = end
+
+        if values is not None:
+            counted = values[added] >= 0
+            table_components, table_values, table_counts = count_pairs(
+                np.concatenate([merged[table_components], added_components[counted]]),
+                np.concatenate([table_values, values[added][counted]]),
+                np.concatenate([table_counts, np.ones(counted.sum(), dtype=np.int64)]))
+
+        yield index, labels, nr_components, (table_components + 1, table_values, table_counts)
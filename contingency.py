@@ -0,0 +1,116 @@
+import numpy as np
+
+# Contingency tables (counts of ground truth / prediction label pairs) for
+# the Rand and VI scores in evaluation.py, in plain numpy. Tables of slices,
+# chunks or whole volumes can be counted anywhere (e.g. in other processes,
+# they pickle) and merged into one.
+
+
+def dense_labels(labels):
+    '''(ids, index) with labels == ids[index] and index counting from 0.
+
+    Labels that are small compared to their number (like the outputs of
+    mahotas.label) go through a lookup table, anything else is sorted.
+
+    '''
+    if len(labels) and labels.min() >= 0 and labels.max() < max(4 * len(labels), 1 << 16):
+        present = np.bincount(labels) > 0
+        lookup = np.cumsum(present) - 1
+        return np.flatnonzero(present), lookup[labels]
+    return np.unique(labels, return_inverse=True)
+
+
+def count_pairs(first, second, counts=None):
+    '''(first ids, second ids, counts) of all distinct pairs of the integer
+    arrays first and second. counts (one per pair, default 1) are summed.
+
+    '''
+    first = np.asarray(first, dtype=np.int64).ravel()
+    second = np.asarray(second, dtype=np.int64).ravel()
+    if counts is not None:
+        counts = np.asarray(counts, dtype=np.int64).ravel()
+    # pairs are counted in a table of all possible pairs if it is small
+    table_size = max(4 * len(first), 1 << 16)
+
+    if len(first) and min(first.min(), second.min()) >= 0 and (first.max() + 1) * (second.max() + 1) <= table_size:
+        # small labels (e.g. of mahotas.label) index the table directly
+        first_ids = np.arange(first.max() + 1)
+        second_ids = np.arange(second.max() + 1)
+        keys = first * len(second_ids) + second
+    else:
+        first_ids, first_index = dense_labels(first)
+        second_ids, second_index = dense_labels(second)
+        keys = first_index * len(second_ids) + second_index
+
+    if len(first_ids) * len(second_ids) <= table_size:
+        pair_counts = np.bincount(keys, counts, minlength=len(first_ids) * len(second_ids))
+        keys = np.flatnonzero(pair_counts)
+        pair_counts = pair_counts[keys]
+    else:
+        keys, inverse = np.unique(keys, return_inverse=True)
+        pair_counts = np.bincount(inverse, counts, minlength=len(keys))
+    # bincount sums weights as floats, exact below 2**53
+    return first_ids[keys // len(second_ids)], second_ids[keys % len(second_ids)], pair_counts.astype(np.int64)
+
+
+def distribution_terms(counts):
+    '''(sum of squares, entropy) of the fractions of counts, the terms of a
+    label distribution in the Rand and VI scores.
+
+    '''
+    fractions = counts.astype(np.double) / counts.sum()
+    return np.sum(fractions ** 2), - np.sum(fractions * np.log(fractions))
+
+
+def group_counts(keys, counts):
+    # sums counts of equal keys, (unique keys, summed counts)
+    keys, inverse = dense_labels(np.asarray(keys, dtype=np.int64))
+    return keys, np.bincount(inverse, counts, minlength=len(keys)).astype(np.int64)
+
+
+class ContingencyTable(object):
+    '''Counts of (ground truth, prediction) label pairs.
+
+    add() counts the pairs of two label arrays (e.g. the masked pixels of a
+    slice), merge() adds the counts of another table, finalize() returns
+    the counts of all pairs, ground truth labels and prediction labels for
+    evaluation.contingency_scores. Added arrays are counted right away, so
+    a table only holds its distinct pairs.
+
+    '''
+    def __init__(self):
+        self.gt = np.zeros(0, dtype=np.int64)
+        self.pred = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, gt, pred, counts=None):
+        # counts of the pairs gt[i], pred[i], 1 for every pair by default
+        gt, pred, counts = count_pairs(gt, pred, counts)
+        self.add_table(gt, pred, counts)
+        return self
+
+    def add_table(self, gt, pred, counts):
+        if len(self.counts) == 0:
+            self.gt, self.pred, self.counts = gt, pred, counts
+        else:
+            self.gt, self.pred, self.counts = count_pairs(np.concatenate([self.gt, gt]), np.concatenate([self.pred, pred]),
+                                                          np.concatenate([self.counts, counts]))
+
+    def merge(self, other):
+        self.add_table(other.gt, other.pred, other.counts)
+        return self
+
+    def finalize(self):
+        '''(pair counts, ground truth counts, prediction counts), the counts of
+        every distinct pair and label, like the counters of fast64counter.
+
+        '''
+        return (self.counts, group_counts(self.gt, self.counts)[1], group_counts(self.pred, self.counts)[1])
+
+
+def merge_tables(tables):
+    # one table with the counts of all tables
+    merged = ContingencyTable()
+    for table in tables:
+        merged.merge(table)
+    return merged
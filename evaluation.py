@@ -1,6 +1,5 @@
 import numpy as np
-from scipy.ndimage.filters import maximum_filter
-import fast64counter
+from scipy.ndimage.morphology import distance_transform_cdt
 import mahotas
 import matplotlib
 import matplotlib.pyplot as plt
@@ -9,8 +8,84 @@ import time
 import glob
 import os
 import cPickle
+from tracing import span, traced
+from component_sweep import component_sweep
+from contingency import ContingencyTable, distribution_terms
+from ground_truth_index import as_ground_truth_index, ground_truth_index
+from results_store import ResultsStore
+
+def bounding_box(mask, margin=0):
+    # slices of the smallest box around the nonzero pixels of mask, grown
+    # by margin pixels on every side (within the image)
+    box = []
+    for axis in xrange(mask.ndim):
+        others = tuple(other for other in xrange(mask.ndim) if other != axis)
+        nonzero = np.flatnonzero(mask.any(axis=others))
+        box.append(slice(max(nonzero[0] - margin, 0), min(nonzero[-1] + 1 + margin, mask.shape[axis])))
+    return tuple(box)
+
+def neighbourhood_maximum(image):
+    # maximum of every 3x3 (3x3x3 in 3d) neighbourhood of a non-negative
+    # image, as maximum_filter(image, 3, mode='constant') but in a few
+    # numpy passes per axis
+    for axis in xrange(image.ndim):
+        lower = tuple(slice(None, -1) if other == axis else slice(None) for other in xrange(image.ndim))
+        upper = tuple(slice(1, None) if other == axis else slice(None) for other in xrange(image.ndim))
+        maximum = image.copy()
+        np.maximum(maximum[upper], image[lower], out=maximum[upper])
+        np.maximum(maximum[lower], image[upper], out=maximum[lower])
+        image = maximum
+    return image
+
+def fill_nearest_labels(im, mask, box, target):
+    '''Fills the background (0) of im[target] in place with the largest
+    label among the nearest (chessboard distance) labelled pixels in
+    im[box], up to the largest distance of a background pixel in mask.
+
+    That is what expanding all regions by one pixel at a time with 3x3
+    maximum filters does, but every pixel is visited once: pixels are
+    ordered by their distance transform and each shell of equal distance
+    takes the maximum of the shell before it. target has to lie in box and
+    box has to hold the nearest labelled pixels of all of target.
 
+    '''
+    # with a border of background, so all neighbours of the box are in window
+    window = np.zeros(tuple(b.stop - b.start + 2 for b in box), dtype=im.dtype)
+    window[(slice(1, -1),) * window.ndim] = im[box]
+    distances = distance_transform_cdt(window == 0, metric='chessboard')
+    # pixels further away than the furthest background pixel in mask are
+    # never reached, the cdt is -1 without any labelled pixel
+    in_target = tuple(slice(t.start - b.start + 1, t.stop - b.start + 1) for t, b in zip(target, box))
+    limit = distances[in_target][mask[target]].max()
+    distances[tuple(slice(1, -1) for axis in window.shape)] *= -1
+    pixels = np.flatnonzero((distances < 0) & (distances >= -limit))
+    reach = -distances.flat[pixels]
+    # the order within a shell does not matter
+    pixels = pixels[np.argsort(reach)]
+    shells = np.cumsum(np.bincount(reach))
+
+    neighbours = np.array([np.ravel_multi_index(offset, window.shape) - np.ravel_multi_index((1,) * window.ndim, window.shape)
+                           for offset in np.ndindex(*(3,) * window.ndim)])
+    neighbours = neighbours[neighbours != 0]
+    for distance in xrange(1, len(shells)):
+        shell = pixels[shells[distance - 1]:shells[distance]]
+        if len(shell) * len(neighbours) > 2 * window.size:
+            # a large shell is cheaper with a separable maximum of the window
+            window.flat[shell] = neighbourhood_maximum(window).flat[shell]
+        else:
+            values = window.take(shell + neighbours[0])
+            for neighbour in neighbours[1:]:
+                np.maximum(values, window.take(shell + neighbour), out=values)
+            window.flat[shell] = values
+    im[target] = window[in_target]
+
+@traced('thin')
 def thin_boundaries(im, mask):
+    '''Labels the boundaries (0) inside mask with their nearest region, as if
+    all regions grew a pixel at a time until no boundary is left in mask.
+    Pixels outside the bounding box of mask keep their label.
+
+    '''
     im = im.copy()
     assert (np.all(im >= 0)), "Label images must be non-negative"
 
@@ -19,13 +94,29 @@ def thin_boundaries(im, mask):
        im[:] = 1.0
        im[0,:] = 2.0
 
-    # repeatedly expand regions by one pixel until the background is gone
-    while (im[mask] == 0).sum() > 0:
-        zeros = (im == 0)
-        im[zeros] = maximum_filter(im, 3)[zeros]
+    # expand regions until the background is gone
+    if np.any(mask & (im == 0)):
+        target = bounding_box(mask)
+        whole = tuple(slice(0, size) for size in im.shape)
+        if target == whole:
+            box = whole
+        elif im.max() == im[im > 0].min():
+            # a single region fills the whole image or not, which decides
+            # about the constant image below
+            target = whole
+            box = whole
+        else:
+            # the box around mask is grown by the largest distance of a
+            # boundary pixel in mask, so it holds all of their nearest regions
+            distances = distance_transform_cdt(im[target] == 0, metric='chessboard')[(mask & (im == 0))[target]]
+            if distances.min() < 0:
+                box = whole
+            else:
+                box = bounding_box(mask, distances.max())
+        fill_nearest_labels(im, mask, box, target)
 
     # make sure image is not constant to avoid zero division
-    if len(np.unique(im))==1:
+    if im.min() == im.max():
         im[0,:] = 5
     return im
 
@@ -66,7 +157,7 @@ def segmentation_metrics(ground_truth, prediction, seq=False):
     Metrics from: Crowdsourcing the creation of image segmentation algorithms
     for connectomics, Arganda-Carreras, et al., 2015, Frontiers in Neuroanatomy
 
-    ground_truth - correct labels
+    ground_truth - correct labels (or their GroundTruthIndex)
     prediction - predicted labels
 
     Boundaries (label == 0) in prediction are thinned until gone, then are
@@ -84,136 +175,208 @@ def segmentation_metrics(ground_truth, prediction, seq=False):
         ground_truth = [ground_truth]
         prediction = [prediction]
 
-    counter_pairwise = fast64counter.ValueCountInt64()
-    counter_gt = fast64counter.ValueCountInt64()
-    counter_pred = fast64counter.ValueCountInt64()
+    ground_truth = [as_ground_truth_index(gt) for gt in ground_truth]
+    frac_pairwise, frac_gt, frac_pred = segmentation_table(ground_truth, prediction).finalize()
+    if len(ground_truth) == 1:
+        gt_terms = (ground_truth[0].sum_of_squares, ground_truth[0].entropy)
+    else:
+        gt_terms = distribution_terms(frac_gt)
+    return scores_from_terms(distribution_terms(frac_pairwise), gt_terms, distribution_terms(frac_pred))
+
 
+def segmentation_table(ground_truth, prediction):
+    '''ContingencyTable of the sequences ground_truth and prediction, with
+    boundaries thinned and masked like segmentation_metrics. Tables of parts
+    of a volume (e.g. computed in other processes) can be merged and scored
+    as one with contingency_scores(*table.finalize()).
+
+    '''
+    table = ContingencyTable()
     for gt, pred in zip(ground_truth, prediction):
-        mask = (gt > 0)
-        pred = thin_boundaries(pred, mask)
-        gt = gt[mask].astype(np.int32)
-        pred = pred[mask].astype(np.int32)
-        counter_pairwise.add_values_pair32(gt, pred)
-        counter_gt.add_values_32(gt)
-        counter_pred.add_values_32(pred)
+        gt = as_ground_truth_index(gt)
+        pred = thin_boundaries(pred, gt.mask)
+        with span('count'):
+            table.merge(gt.table(pred))
+    return table
 
-    # fetch counts
-    frac_pairwise = counter_pairwise.get_counts()[1]
-    frac_gt = counter_gt.get_counts()[1]
-    frac_pred = counter_pred.get_counts()[1]
 
-    # normalize to probabilities
-    frac_pairwise = frac_pairwise.astype(np.double) / frac_pairwise.sum()
-    frac_gt = frac_gt.astype(np.double) / frac_gt.sum()
-    frac_pred = frac_pred.astype(np.double) / frac_pred.sum()
+def contingency_scores(frac_pairwise, frac_gt, frac_pred):
+    '''The Rand and VI scores of segmentation_metrics from the counts of all
+    (ground truth, prediction) label pairs, ground truth labels and
+    prediction labels.
 
-    alphas = {'F-score': 0.5, 'split': 0.0, 'merge': 1.0}
+    '''
+    return scores_from_terms(distribution_terms(frac_pairwise), distribution_terms(frac_gt),
+                             distribution_terms(frac_pred))
+
+
+# alpha of every score in the Rand and VI results
+score_alphas = {'F-score': 0.5, 'split': 0.0, 'merge': 1.0}
+
+def scores_from_terms(pair_terms, gt_terms, pred_terms):
+    '''Rand and VI scores from the (sum of squares, entropy) of the pair,
+    ground truth and prediction fractions, see Rand and VI.
 
-    Rand_scores = {k: Rand(frac_pairwise, frac_gt, frac_pred, v) for k, v in alphas.items()}
-    VI_scores = {k: VI(frac_pairwise, frac_gt, frac_pred, v) for k, v in alphas.items()}
+    '''
+    pair_squares, pair_entropy = pair_terms
+    gt_squares, gt_entropy = gt_terms
+    pred_squares, pred_entropy = pred_terms
+    mutual_information = gt_entropy + pred_entropy - pair_entropy
+
+    with span('score'):
+        Rand_scores = {k: pair_squares / (v * gt_squares + (1.0 - v) * pred_squares) for k, v in score_alphas.items()}
+        VI_scores = {k: mutual_information / ((1.0 - v) * gt_entropy + v * pred_entropy) for k, v in score_alphas.items()}
 
     return {'Rand': Rand_scores, 'VI': VI_scores}
 
 
+@traced('sweep')
+def threshold_sweep_metrics(ground_truth, probabilities, thresholds):
+    '''segmentation_metrics(ground_truth, mahotas.label(probabilities > t)[0])
+    for every threshold t, as a list in the order of thresholds.
+
+    The labelings of all thresholds come from one component_sweep, which
+    keeps the counts of (component, ground truth) pairs of the foreground
+    up to date while components merge. Per threshold only the
+    boundary pixels, which thin_boundaries gives to one of the regions, are
+    counted. ground_truth can be a GroundTruthIndex, its terms are reused
+    for every threshold.
+
+    '''
+    ground_truth = as_ground_truth_index(ground_truth)
+    mask = ground_truth.mask
+    gt_values = ground_truth.label_image()
+    gt_terms = (ground_truth.sum_of_squares, ground_truth.entropy)
+
+    # with two or more regions thin_boundaries comes down to a fill of the
+    # box around mask from the whole image
+    target = bounding_box(mask) if mask.any() else None
+    whole = tuple(slice(0, size) for size in mask.shape)
+
+    results = [None] * len(thresholds)
+    # the sweep yields the thresholds from the highest to the lowest
+    sweep = component_sweep(probabilities, thresholds, gt_values)
+    for threshold in sorted(thresholds, reverse=True):
+        with span('threshold', threshold=float(threshold)):
+            with span('label'):
+                index, labels, nr_labels, (table_labels, table_values, table_counts) = next(sweep)
+            if nr_labels > 1:
+                boundary = mask & (labels == 0)
+                if target is not None:
+                    with span('thin'):
+                        # the label image is not used by the sweep any more
+                        fill_nearest_labels(labels, mask, whole, target)
+            else:
+                pred = thin_boundaries(labels, mask)
+            with span('count'):
+                table = ContingencyTable()
+                if nr_labels > 1:
+                    table.add_table(table_values, table_labels, table_counts)
+                    table.add(gt_values[boundary], labels[boundary])
+                else:
+                    # thin_boundaries relabels constant images, count every pixel
+                    table.add(gt_values[mask], pred[mask])
+                frac_pairwise, frac_gt, frac_pred = table.finalize()
+            results[index] = scores_from_terms(distribution_terms(frac_pairwise), gt_terms, distribution_terms(frac_pred))
+    return results
+
+
 # Just doing one, so the interface is easier for the network training
 # And yes that means I should refactor the function above... when I have time
 def quick_Rand(gt, pred, seq=False):
-    counter_pairwise = fast64counter.ValueCountInt64()
-    counter_gt = fast64counter.ValueCountInt64()
-    counter_pred = fast64counter.ValueCountInt64()
-
-    mask = (gt > 0)
-    pred = thin_boundaries(pred, mask)
-    gt = gt[mask].astype(np.int32)
-    pred = pred[mask].astype(np.int32)
-    counter_pairwise.add_values_pair32(gt, pred)
-    counter_gt.add_values_32(gt)
-    counter_pred.add_values_32(pred)
-
-    # fetch counts
-    frac_pairwise = counter_pairwise.get_counts()[1]
-    frac_gt = counter_gt.get_counts()[1]
-    frac_pred = counter_pred.get_counts()[1]
-
-    # normalize to probabilities
-    frac_pairwise = frac_pairwise.astype(np.double) / frac_pairwise.sum()
-    frac_gt = frac_gt.astype(np.double) / frac_gt.sum()
-    frac_pred = frac_pred.astype(np.double) / frac_pred.sum()
-
-    return Rand(frac_pairwise, frac_gt, frac_pred, 0.5)
+    gt = as_ground_truth_index(gt)
+    frac_pairwise, frac_gt, frac_pred = segmentation_table([gt], [pred]).finalize()
+
+    return scores_from_terms(distribution_terms(frac_pairwise), (gt.sum_of_squares, gt.entropy),
+                             distribution_terms(frac_pred))['Rand']['F-score']
 
 def Rand_membrane_prob(im_pred, im_gt):
-    Rand_score = []
-    for thresh in np.arange(0,1,0.05):
-        # white regions, black boundaries
-        im_seg = im_pred>thresh
-        # connected components
-        seeds, nr_regions = mahotas.label(im_seg)
-        result = quick_Rand(im_gt, seeds)        
-        Rand_score.append(result)
+    # white regions, black boundaries, connected components of every threshold
+    results = threshold_sweep_metrics(im_gt, im_pred, np.arange(0,1,0.05))
+    Rand_score = [result['Rand']['F-score'] for result in results]
 
     return np.max(Rand_score)
 
-def run_evaluation_boundary_predictions(network_name):
-    pathPrefix = './AC4_small/'
+# thresholds of the boundary probabilities in the evaluation
+evaluation_thresholds = np.arange(0,1,0.05)
+
+def evaluation_files(network_name, pathPrefix='./AC4_small/'):
+    # (ground truth files, boundary probability files) of a network, slice by slice
     img_gt_search_string = pathPrefix + 'labels/*.tif'
     img_pred_search_string = pathPrefix + 'boundaryProbabilities/'+network_name+'/*.tif'
 
     img_files_gt = sorted( glob.glob( img_gt_search_string ) )
     img_files_pred = sorted( glob.glob( img_pred_search_string ) )
+    return img_files_gt[:len(img_files_pred)], img_files_pred
+
+def evaluate_slice(gt_file, pred_file, thresholds=evaluation_thresholds):
+    # metrics of one slice for every threshold
+    # mask, labels and their terms are saved next to the labels
+    im_gt = ground_truth_index(gt_file)
+    im_pred = mahotas.imread(pred_file)
+    im_pred = im_pred / 255.0
+
+    # white regions, black boundaries, connected components of every threshold
+    return threshold_sweep_metrics(im_gt, im_pred, thresholds)
+
+def results_file(pathPrefix='./AC4_small/'):
+    # the ResultsStore of all networks in pathPrefix
+    return pathPrefix + 'evaluation.sqlite'
+
+def slice_name(pred_file):
+    # slices are stored by the name of their boundary probability file
+    return os.path.basename(pred_file)
+
+def score_rows(network_name, pred_file, thresholds, results):
+    # ResultsStore rows of the metrics of a slice at thresholds
+    return [(network_name, slice_name(pred_file), threshold, metric, alpha, result[metric][score])
+            for threshold, result in zip(thresholds, results)
+            for metric in ('Rand', 'VI') for score, alpha in score_alphas.items()]
+
+def missing_thresholds(store, network_name, pred_file):
+    # indices of the evaluation_thresholds of a slice that are not in store yet
+    stored = store.thresholds(network_name, slice_name(pred_file))
+    return np.array([i for i, threshold in enumerate(evaluation_thresholds) if threshold not in stored], dtype=np.int64)
+
+def save_evaluation(store, network_name, pathPrefix='./AC4_small/'):
+    '''Writes the scores of a network in store to pathPrefix/network_name.pkl,
+    lists of the scores of every threshold of every slice as before there
+    was a store.
 
-    allVI = []
-    allVI_split = []
-    allVI_merge = []
+    '''
+    scores = []
+    for metric in ('VI', 'Rand'):
+        for score in ('F-score', 'split', 'merge'):
+            slices, thresholds, values = store.curves(network_name, metric, score_alphas[score])
+            scores.append(values.tolist())
+    allVI, allVI_split, allVI_merge, allRand, allRand_split, allRand_merge = scores
 
-    allRand = []
-    allRand_split = []
-    allRand_merge = []
+    with open(pathPrefix+network_name+'.pkl', 'wb') as file:
+        cPickle.dump((allVI, allVI_split, allVI_merge, allRand, allRand_split, allRand_merge), file)
+
+def run_evaluation_boundary_predictions(network_name, pathPrefix='./AC4_small/', store=None):
+    # serial version, see parallel_evaluation for evaluating on all cores
+    # scores go to store (default: results_file(pathPrefix)), thresholds
+    # of slices that are in store already are skipped
+    if store is None:
+        store = ResultsStore(results_file(pathPrefix))
+    img_files_gt, img_files_pred = evaluation_files(network_name, pathPrefix)
 
     for i in xrange(np.shape(img_files_pred)[0]):
         print img_files_pred[i]
-        im_gt = mahotas.imread(img_files_gt[i])
-        im_pred = mahotas.imread(img_files_pred[i])
-        im_pred = im_pred / 255.0
-
-        VI_score = []
-        VI_score_split = []
-        VI_score_merge = []
-
-        Rand_score = []
-        Rand_score_split = []
-        Rand_score_merge = []
-    
+        missing = missing_thresholds(store, network_name, img_files_pred[i])
+        if len(missing) == 0:
+            print "is already done"
+            continue
         start_time = time.clock()
 
-        for thresh in np.arange(0,1,0.05):
-            # white regions, black boundaries
-            im_seg = im_pred>thresh
-            # connected components
-            seeds, nr_regions = mahotas.label(im_seg)
-            
-            result = segmentation_metrics(im_gt, seeds, seq=False)   
-            
-            VI_score.append(result['VI']['F-score'])
-            VI_score_split.append(result['VI']['split'])
-            VI_score_merge.append(result['VI']['merge'])
-
-            Rand_score.append(result['Rand']['F-score'])
-            Rand_score_split.append(result['Rand']['split'])
-            Rand_score_merge.append(result['Rand']['merge'])
+        thresholds = evaluation_thresholds[missing]
+        results = evaluate_slice(img_files_gt[i], img_files_pred[i], thresholds)
+        store.insert(score_rows(network_name, img_files_pred[i], thresholds, results))
 
         print "This took in seconds: ", time.clock() - start_time
 
-        allVI.append(VI_score)
-        allVI_split.append(VI_score_split)
-        allVI_merge.append(VI_score_merge)
-
-        allRand.append(Rand_score)
-        allRand_split.append(Rand_score_split)
-        allRand_merge.append(Rand_score_merge)
-        
-    with open(pathPrefix+network_name+'.pkl', 'wb') as file:
-        cPickle.dump((allVI, allVI_split, allVI_merge, allRand, allRand_split, allRand_merge), file)
+    save_evaluation(store, network_name, pathPrefix)
     
 
     # for i in xrange(len(allVI)):
@@ -264,19 +427,18 @@ def run_evaluation_segmentations3D():
     all_VI.append(result['VI']['F-score'])
     return seeds
 
-def plot_evaluations():
-    pathPrefix = './AC4_small/'
-    search_string = pathPrefix + '*.pkl'
-    files = sorted( glob.glob( search_string ) )
-
-    for i in xrange(np.shape(files)[0]):
-        with open(files[i], 'r') as file:
-            allVI, allVI_split, allVI_merge, allRand, allRand_split, allRand_merge = cPickle.load(file)
-            # for ii in xrange(len(allVI)):
-            #     plt.plot(np.arange(0,1,0.05), allVI[ii], colors[i]+'--', alpha=0.5)
-            plt.plot(np.arange(0,1,0.05), np.mean(allRand, axis=0), label=files[i])
-            #print "VI: ", files[i], np.max(np.mean(allVI, axis=0))
-            print "Rand:", files[i], np.max(np.mean(allRand, axis=0))
+def plot_evaluations(pathPrefix='./AC4_small/'):
+    # means and maxima are computed by the store, no curves are loaded
+    store = ResultsStore(results_file(pathPrefix))
+
+    for network_name in store.networks():
+        thresholds, mean_Rand = store.mean_curve(network_name, 'Rand', score_alphas['F-score'])
+        # for ii in xrange(len(allVI)):
+        #     plt.plot(np.arange(0,1,0.05), allVI[ii], colors[i]+'--', alpha=0.5)
+        plt.plot(thresholds, mean_Rand, label=network_name)
+    for network_name, threshold, best_Rand in store.best_means('Rand', score_alphas['F-score']):
+        #print "VI: ", files[i], np.max(np.mean(allVI, axis=0))
+        print "Rand:", network_name, best_Rand, "at threshold", threshold
     plt.title("Rand_info comparison - higher is better, bounded by 1")
     plt.xlabel("Threshold")
     plt.ylabel("Rand_info")
@@ -303,11 +465,9 @@ if __name__=="__main__":
 
     network_names = [os.path.basename(p[:-1]) for p in glob.glob('AC4_small/boundaryProbabilities/*/')]
 
-    for name in network_names:
-        if not os.path.exists('AC4_small/'+name+'.pkl'):
-            print name, "is new"
-            seeds = run_evaluation_boundary_predictions(name)
-        else:
-            print name, "is already done"
+    # all slices of all networks on all cores, slices and thresholds in
+    # AC4_small/evaluation.sqlite already are skipped
+    from parallel_evaluation import run_parallel_evaluation
+    run_parallel_evaluation(network_names, 'AC4_small/')
     
     plot_evaluations()
@@ -1,543 +1,1143 @@
 import os
-import skimage.transform
-import time
 import glob
+import fnmatch
 import numpy as np
 import mahotas
-import random
 import matplotlib
 import matplotlib.pyplot as plt
 import scipy
 import scipy.ndimage
-from scipy.ndimage.filters import maximum_filter
+from volume_cache import lazy_stack, cached_slice, slice_cache_size, SliceStore, LayerWindow
+from sampling_index import ClassIndex, ImportanceMap
+from chunked_volume import write_volume, is_volume, ChunkedVolume, VolumeWindow
+from tracing import span, traced
+
+def dark_pixels(image):
+    # membrane pixels, image is [0,1] or uint8 [0,255]
+    bright = 0.7
+    if image.dtype == np.uint8:
+        bright = 0.7*255
+    return image <= bright
+
+
+def geodesic_boundary_distance(image, label):
+    '''Number of growing steps adjust_imprecise_boundaries needs to reach each pixel.
+
+    image and label are single images or stacks (n_images, rows, cols). Labels
+    grow by one pixel per step in +row, +col or both (the window of
+    maximum_filter(label, 2)) and only through dark pixels, so the distance is
+    the length of a shortest monotone path and one raster pass computes it
+    for every pixel. Pixels that are never reached get distance 2**30.
+
+    '''
+    seeds = label == 1
+    dark = dark_pixels(image)
+    if label.ndim == 2:
+        seeds = seeds[None]
+        dark = dark[None]
+    # paths are symmetric in rows and cols, loop over the shorter axis
+    transposed = seeds.shape[1] > seeds.shape[2]
+    if transposed:
+        seeds = seeds.transpose(0, 2, 1)
+        dark = dark.transpose(0, 2, 1)
+
+    n_images, rows, cols = seeds.shape
+    unreached = 2**30
+    # earlier runs of a row get a larger offset, so the running minimum
+    # never carries a distance across a bright pixel
+    segment_offset = 2*unreached + cols
+    columns = np.arange(cols)
+
+    distance = np.empty(seeds.shape, dtype=np.int32)
+    previous = np.full((n_images, cols), unreached, dtype=np.int64)
+    for row in xrange(rows):
+        # best predecessor above, above left or left (left only for seeds)
+        step = previous.copy()
+        step[:, 1:] = np.minimum(step[:, 1:], previous[:, :-1])
+        step[:, 1:][seeds[:, row, :-1]] = 0
+        step += 1
+        step[~dark[:, row]] = unreached
+        # moving right within a run of dark pixels costs one step per pixel
+        segments = np.cumsum(~dark[:, row], axis=1)
+        offsets = (segments[:, -1:] - segments)*segment_offset
+        current = np.minimum.accumulate(step - columns + offsets, axis=1) + columns - offsets
+        current = np.where(dark[:, row], np.minimum(current, unreached), unreached)
+        distance[:, row] = current
+        # seeds start paths whether they are dark or not
+        previous = np.where(seeds[:, row], 0, current)
+
+    if transposed:
+        distance = distance.transpose(0, 2, 1)
+    if label.ndim == 2:
+        distance = distance[0]
+    return distance
+
 
 # the idea is to grow the labels to cover the whole membrane
-# image and label should be [0,1]
+# image and label should be [0,1], image may also be uint8 [0,255]
+# works on single images and on stacks (n_images, rows, cols)
 def adjust_imprecise_boundaries(image, label, number_iterations=5):
-    label = label.copy()
-    label_orig = label.copy()
-
-    for i in xrange(number_iterations):
-        # grow labels by one pixel
-        label = maximum_filter(label, 2)
-        # only keep pixels that are on dark membrane
-        non_valid_label = np.logical_and(label==1, image>0.7)
-        label[non_valid_label] = 0
+    # same result as number_iterations times growing the labels by one pixel
+    # with maximum_filter(label, 2) and removing them from bright pixels,
+    # but the cost does not depend on number_iterations
+    grown = np.logical_and(dark_pixels(image), geodesic_boundary_distance(image, label) <= number_iterations)
 
     # make sure original labels are preserved
-    label = np.logical_or(label==1, label_orig==1)
+    label = np.logical_or(label==1, grown)
 
     return label
 
 
-def deform_images(image1, image2, image3=None):
-    # assumes image is uint8
-    def apply_deformation(image, coordinates):
-        # ndimage expects uint8 otherwise introduces artifacts. Don't ask me why, its stupid.
-        deformed = scipy.ndimage.map_coordinates(image, coordinates, mode='reflect')
-        deformed = np.reshape(deformed, image.shape) 
-        return deformed
+def as_uint8(image):
+    # [0,1] images are scaled, uint8 images are used as they are
+    if image.dtype == np.uint8:
+        return image
+    return np.uint8(image*255)
+
+
+# smoothed displacement fields, one bank per patch shape and parameters,
+# see displacement_bank
+displacement_banks = {}
+
+
+def displacement_bank(shape, bank_size=32, scale=10, sigma=5, seed=0):
+    '''Bank of bank_size elastic deformations for images of the given shape.
+
+    Every field is Gaussian noise with the given scale smoothed by a Gaussian
+    of width sigma. It is stored compactly as precomputed bilinear sampling
+    indices and float16 weights, so applying a field is a handful of takes.
+    The bank is computed once per process and uses its own seed,
+    the sampling rng only picks fields from it.
+
+    '''
+    key = (tuple(shape), bank_size, scale, sigma, seed)
+    if key not in displacement_banks:
+        rows, cols = shape
+        bank_rng = np.random.RandomState(seed)
+        coords_rows, coords_cols = np.meshgrid(np.arange(rows), np.arange(cols), indexing='ij')
+
+        bank = []
+        for field in xrange(bank_size):
+            source_rows = coords_rows + scipy.ndimage.gaussian_filter(bank_rng.normal(size=shape, scale=scale), sigma=sigma)
+            source_cols = coords_cols + scipy.ndimage.gaussian_filter(bank_rng.normal(size=shape, scale=scale), sigma=sigma)
+            # mirror at the border like map_coordinates(mode='reflect')
+            source_rows = np.abs(source_rows)
+            source_rows = (rows - 1) - np.abs((rows - 1) - source_rows)
+            source_cols = np.abs(source_cols)
+            source_cols = (cols - 1) - np.abs((cols - 1) - source_cols)
+
+            rows_floor = np.clip(np.floor(source_rows), 0, max(rows - 2, 0))
+            cols_floor = np.clip(np.floor(source_cols), 0, max(cols - 2, 0))
+            bank.append((
+                np.int32(rows_floor*cols + cols_floor).ravel(),
+                np.float16(source_rows - rows_floor).ravel(),
+                np.float16(source_cols - cols_floor).ravel()))
+        displacement_banks[key] = bank
+    return displacement_banks[key]
+
+
+@traced('deform')
+def apply_displacement(images, labels, field):
+    # images and labels are (channels, rows, cols), images are interpolated
+    # bilinearly, labels are taken from the nearest pixel
+    flat_index, rows_fraction, cols_fraction = field
+    cols = images.shape[2]
+    rows_fraction = rows_fraction.astype(np.float32)
+    cols_fraction = cols_fraction.astype(np.float32)
+
+    flat_images = images.reshape(images.shape[0], -1)
+    top = flat_images.take(flat_index, axis=1).astype(np.float32)
+    top += (flat_images.take(flat_index + 1, axis=1) - top) * cols_fraction
+    bottom = flat_images.take(flat_index + cols, axis=1).astype(np.float32)
+    bottom += (flat_images.take(flat_index + cols + 1, axis=1) - bottom) * cols_fraction
+    top += (bottom - top) * rows_fraction
+    deformed_images = np.round(top).astype(images.dtype).reshape(images.shape)
+
+    nearest_index = flat_index + (rows_fraction >= 0.5)*cols + (cols_fraction >= 0.5)
+    deformed_labels = labels.reshape(labels.shape[0], -1).take(nearest_index, axis=1).reshape(labels.shape)
+    return deformed_images, deformed_labels
+
+
+def deform_images(image1, image2, image3=None, rng=np.random):
+    # image1 and image2 are uint8 or [0,1], image3 is uint8.
+    # image1 is interpolated, the membrane image2 and the label image3 are
+    # deformed with nearest neighbour, so they stay binary and keep their ids
+    bank = displacement_bank(image1.shape)
+    field = bank[rng.randint(len(bank))]
+
+    labels = [as_uint8(image2)]
+    if not image3 is None:
+        labels.append(image3)
+    deformed_images, deformed_labels = apply_displacement(as_uint8(image1)[None], np.array(labels), field)
+
+    return (deformed_images[0],) + tuple(deformed_labels)
+
+
+def deform_layers(images, labels, rng=np.random):
+    # images (layers, rows, cols) uint8 are interpolated, labels (channels,
+    # rows, cols) use nearest neighbour, both with the same random field
+    bank = displacement_bank(images.shape[1:])
+    field = bank[rng.randint(len(bank))]
+    return apply_displacement(images, labels, field)
+
+
+def deform_images_list(images, nr_label_channels=0, rng=np.random):
+    # assumes image is uint8, the last nr_label_channels channels (membranes,
+    # labels) are deformed with nearest neighbour, all others are interpolated
+    channels = np.uint8(images).transpose(2, 0, 1)
+    nr_image_channels = images.shape[2] - nr_label_channels
+    deformed_images, deformed_labels = deform_layers(channels[:nr_image_channels], channels[nr_image_channels:], rng)
+
+    return np.concatenate([deformed_images, deformed_labels]).transpose(1, 2, 0)
+
+
+def dihedral_offsets(patchSize):
+    # row and column offsets from the patch center, shape (8, 2, size, size),
+    # for every combination of fliplr and rot90, indexed by flip*4 + rotation
+    border_patch = np.int(np.ceil(patchSize/2.0))
+    offset = np.arange(2*border_patch - 1) - (border_patch - 1)
+    offset_rows, offset_cols = np.meshgrid(offset, offset, indexing='ij')
+
+    offsets = []
+    for flip in (False, True):
+        for rotation in xrange(4):
+            rows, cols = offset_rows, offset_cols
+            if flip:
+                rows, cols = np.fliplr(rows), np.fliplr(cols)
+            offsets.append([np.rot90(rows, rotation), np.rot90(cols, rotation)])
+    return np.array(offsets, dtype=np.float32)
+
+
+def dihedral_indices(patchSize):
+    # flat pixel indices into a patch of shape (8, size*size), pixel k of the
+    # flipped and rotated patch is pixel [code, k] of the original one, codes
+    # flip*4 + rotation as in dihedral_offsets
+    pixels = np.arange(patchSize**2).reshape(patchSize, patchSize)
+    indices = []
+    for flip in (False, True):
+        for rotation in xrange(4):
+            index = np.fliplr(pixels) if flip else pixels
+            indices.append(np.rot90(index, rotation).ravel())
+    return np.array(indices)
+
+
+def bilinear_sample(image, rows, cols):
+    # bilinear interpolation of image at float coordinates (rows, cols), which
+    # have to lie inside the image, in float32 (cheaper than map_coordinates)
+    rows_floor = np.floor(rows)
+    cols_floor = np.floor(cols)
+    rows_fraction = rows - rows_floor
+    cols_fraction = cols - cols_floor
+
+    flat_image = image.ravel()
+    flat_index = rows_floor.astype(np.int64)*image.shape[1] + cols_floor.astype(np.int64)
+    flat_index = np.minimum(flat_index, image.size - image.shape[1] - 2)
+    top = flat_image.take(flat_index).astype(np.float32)
+    top += (flat_image.take(flat_index + 1) - top) * cols_fraction
+    bottom = flat_image.take(flat_index + image.shape[1]).astype(np.float32)
+    bottom += (flat_image.take(flat_index + image.shape[1] + 1) - bottom) * cols_fraction
+    top += (bottom - top) * rows_fraction
+    return top
+
+
+@traced('augment')
+def rotate_patches(image, rows, cols, patchSize, angles, flips, rotations, batch_size=32):
+    '''Rotated and flipped patches centered at (rows, cols), shape (n, size, size).
+
+    Same result (up to interpolation) as skimage.transform.rotate by angles
+    degrees on an oversized crop, cropping, fliplr where flips is set and
+    np.rot90 by rotations. The whole transform is folded into one coordinate
+    map, so each batch of patches is interpolated in one vectorized pass.
+    uint8 images give patches in [0,1].
+
+    '''
+    offsets = dihedral_offsets(patchSize)
+    size = offsets.shape[-1]
+    patches = np.zeros((len(rows), size, size), dtype=np.float32)
+
+    for start in xrange(0, len(rows), batch_size):
+        batch = slice(start, start + batch_size)
+        theta = np.float32(np.deg2rad(angles[batch]))[:, None, None]
+        cos_theta = np.cos(theta)
+        sin_theta = np.sin(theta)
+
+        codes = np.int32(flips[batch])*4 + rotations[batch]
+        offset_rows = offsets[codes, 0]
+        offset_cols = offsets[codes, 1]
+
+        # skimage rotates counter-clockwise around the patch center
+        source_rows = rows[batch][:, None, None] + sin_theta*offset_cols + cos_theta*offset_rows
+        source_cols = cols[batch][:, None, None] + cos_theta*offset_cols - sin_theta*offset_rows
+        patches[batch] = bilinear_sample(image, source_rows, source_cols)
+
+    if image.dtype == np.uint8:
+        patches /= 255.
+    return patches
+
+
+# integer images whose values span at most histogram_range values are
+# counted in a histogram, wider ranges (e.g. uint32 ids) use np.partition
+histogram_range = 1 << 16
+
+
+def intensity_histogram(img):
+    # (first value, counts of every integer value from first on), None if
+    # the values span more than histogram_range values
+    values = img.ravel()
+    if values.dtype == np.bool_:
+        values = values.view(np.uint8)
+    first = values.min()
+    if int(values.max()) - int(first) >= histogram_range:
+        return None
+    # the difference wraps around in the image type but is exact unsigned
+    offsets = (values - first).view(np.dtype('u%d' % values.dtype.itemsize))
+    return int(first), np.bincount(offsets.astype(np.intp))
+
+
+def histogram_values(histogram):
+    # all values counted in histogram, sorted
+    first, counts = histogram
+    return np.repeat(np.arange(len(counts)) + first, counts)
+
+
+def merge_histograms(histograms):
+    # sums intensity histograms of several images or tiles
+    histograms = list(histograms)
+    first = min(h_first for h_first, counts in histograms)
+    end = max(h_first + len(counts) for h_first, counts in histograms)
+    merged = np.zeros(end - first, dtype=np.int64)
+    for h_first, counts in histograms:
+        merged[h_first - first:h_first - first + len(counts)] += counts
+    return first, merged
+
+
+def saturation_ranks(nr_values, saturation_level):
+    # positions of the lower and upper bound in the sorted values
+    return (np.int(nr_values * (saturation_level / 2)),
+            np.int(nr_values * (1 - saturation_level / 2)))
+
+
+def histogram_saturation_bounds(histogram, saturation_level=0.05):
+    first, counts = histogram
+    cumulative = np.cumsum(counts)
+    ranks = saturation_ranks(cumulative[-1], saturation_level)
+    if ranks[1] >= cumulative[-1]:
+        raise IndexError('saturation level selects a value past the end of the image')
+    # the value at rank k is the first one with more than k values up to it
+    values = np.searchsorted(cumulative, ranks, side='right') + first
+    return np.float32(values[0]), np.float32(values[1])
+
+
+def saturation_bounds(img, saturation_level=0.05):
+    '''Lower and upper saturation values of img as used by normalizeImage.
+
+    The same values as reading them from np.sort(img.ravel()), but in linear
+    time: integer images with a small value range use a histogram, other
+    images np.partition. img can be a single image, a tile or a whole stack.
+
+    '''
+    if img.dtype.kind in 'biu':
+        histogram = intensity_histogram(img)
+        if histogram is not None:
+            return histogram_saturation_bounds(histogram, saturation_level)
+    values = img.ravel()
+    ranks = saturation_ranks(len(values), saturation_level)
+    values = np.partition(values, ranks)
+    return np.float32(values[ranks[0]]), np.float32(values[ranks[1]])
+
+
+def volume_saturation_bounds(images, saturation_level=0.05):
+    # saturation bounds over all images (e.g. a generator reading the slices of
+    # a volume), integer images are streamed through one merged histogram as
+    # long as all their values span at most histogram_range values
+    histogram = None
+    values = []
+    for img in images:
+        img_histogram = None
+        if not values and img.dtype.kind in 'biu':
+            img_histogram = intensity_histogram(img)
+        if img_histogram is not None:
+            if histogram is None:
+                histogram = img_histogram
+                continue
+            first = min(histogram[0], img_histogram[0])
+            end = max(histogram[0] + len(histogram[1]), img_histogram[0] + len(img_histogram[1]))
+            if end - first <= histogram_range:
+                histogram = merge_histograms([histogram, img_histogram])
+                continue
+        # from here on the values are collected and partitioned
+        if histogram is not None:
+            values.append(histogram_values(histogram))
+            histogram = None
+        values.append(img.ravel())
+    if histogram is not None:
+        return histogram_saturation_bounds(histogram, saturation_level)
+    return saturation_bounds(np.concatenate(values), saturation_level)
+
+
+@traced('normalize')
+def normalizeImage(img, saturation_level=0.05, bounds=None): #was 0.005
+	# bounds=(minVal, maxVal) from saturation_bounds or volume_saturation_bounds
+	# normalizes tiles or slices consistently with their whole volume
+	if bounds is None:
+		bounds = saturation_bounds(img, saturation_level)
+	minVal, maxVal = bounds
+	normImg = np.float32(img - minVal) * (255 / (maxVal-minVal))
+	normImg[normImg<0] = 0
+	normImg[normImg>255] = 255
+	return (np.float32(normImg) / 255.0)
+	
+	
+# compact storage types for the sampling volumes, patches are only
+# converted to float32 when they are emitted
+def read_normalized_image(file_name, saturation_level=0.05):
+    # normalized [0,1] and quantized to uint8 [0,255]
+    with span('read', file=file_name):
+        image = mahotas.imread(file_name)
+    return np.uint8(np.round(normalizeImage(image, saturation_level) * 255))
 
-    displacement_x = np.random.normal(size=image1.shape, scale=10)
-    displacement_y = np.random.normal(size=image1.shape, scale=10)
-    
-    # smooth over image
-    coords_x, coords_y = np.meshgrid(np.arange(0,image1.shape[0]), np.arange(0,image1.shape[1]), indexing='ij')
 
-    displacement_x = coords_x.flatten() #+ scipy.ndimage.gaussian_filter(displacement_x, sigma=5).flatten()
-    displacement_y = coords_y.flatten() #+ scipy.ndimage.gaussian_filter(displacement_y, sigma=5).flatten()
-    
-    coordinates = np.vstack([displacement_x, displacement_y])
-    
-    deformed1 = apply_deformation(np.uint8(image1*255), coordinates)
-    deformed2 = apply_deformation(np.uint8(image2*255), coordinates)
-    if not image3 is None:
-        deformed3 = apply_deformation(image3, coordinates)
-        return (deformed1, deformed2, deformed3)
+def read_binary_image(file_name):
+    with span('read', file=file_name):
+        return mahotas.imread(file_name) > 0
 
-    return (deformed1, deformed2)
 
+def read_label_image(file_name):
+    with span('read', file=file_name):
+        return mahotas.imread(file_name)
 
-def deform_images_list(images):
-    # assumes image is uint8
-    def apply_deformation(image, coordinates):
-        # ndimage expects uint8 otherwise introduces artifacts. Don't ask me why, its stupid.
-        deformed = scipy.ndimage.map_coordinates(image, coordinates, mode='reflect')
-        deformed = np.reshape(deformed, image.shape) 
-        return deformed
 
-    displacement_x = np.random.normal(size=images.shape[:2], scale=10)
-    displacement_y = np.random.normal(size=images.shape[:2], scale=10)
+def read_adjusted_membrane(file_name, gray_file, number_iterations):
+    # membranes of file_name grown to the dark pixels of gray_file, see
+    # adjust_imprecise_boundaries
+    return adjust_imprecise_boundaries(read_normalized_image(gray_file), read_binary_image(file_name), number_iterations)
 
-    # smooth over image
-    coords_x, coords_y = np.meshgrid(np.arange(0,images.shape[0]), np.arange(0,images.shape[1]), indexing='ij')
 
-    displacement_x = coords_x.flatten() #+ scipy.ndimage.gaussian_filter(displacement_x, sigma=5).flatten()
-    displacement_y = coords_y.flatten() #+ scipy.ndimage.gaussian_filter(displacement_y, sigma=5).flatten()
-    
-    coordinates = np.vstack([displacement_x, displacement_y])
-    
-    deformed = images.copy()
-    for i in xrange(images.shape[2]):
-        deformed[:,:,i] = apply_deformation(np.uint8(images[:,:,i]), coordinates)
-    
-    return deformed
+def data_path_prefix():
+    # DATA_PATH selects another data set, e.g. one from synthetic_data.py
+    if os.environ.get('DATA_PATH'):
+        return os.path.join(os.environ['DATA_PATH'], '')
+    if os.path.exists('/media/vkaynig/Data1/Cmor_paper_data/'):
+        return '/media/vkaynig/Data1/Cmor_paper_data/'
+    return '/n/pfister_lab/vkaynig/'
 
 
-def normalizeImage(img, saturation_level=0.05): #was 0.005
-	sortedValues = np.sort( img.ravel())
-	minVal = np.float32(sortedValues[np.int(len(sortedValues) * (saturation_level / 2))])
-	maxVal = np.float32(sortedValues[np.int(len(sortedValues) * (1 - saturation_level / 2))])
-	normImg = np.float32(img - minVal) * (255 / (maxVal-minVal))
-	normImg[normImg<0] = 0
-	normImg[normImg>255] = 255
-	return (np.float32(normImg) / 255.0)
-	
-	
-def generate_experiment_data_supervised(purpose='train', nsamples=1000, patchSize=29, balanceRate=0.5, rng=np.random):
-    start_time = time.time()
+# channels of a converted volume: name, directory below the data path,
+# read function and its parameters, the same preprocessing as the samplers
+volume_channels = [
+    ('gray', 'images/', read_normalized_image, {'saturation_level': 0.05}),
+    ('membranes', 'labels/membranes_fullContour/', read_binary_image, {}),
+    ('membranes_nonDilate', 'labels/membranes_nonDilate/', read_binary_image, {}),
+    ('labels', 'labels/', read_label_image, {}),
+    ('background', 'labels/background_nonDilate/', read_binary_image, {}),
+]
+
+
+def chunked_volume_path(purpose='train'):
+    # the samplers read the volume of a purpose from here if it exists
+    return data_path_prefix() + 'volumes/' + purpose + '/'
 
-    if os.path.exists('/media/vkaynig/Data1/Cmor_paper_data/'):
-        pathPrefix = '/media/vkaynig/Data1/Cmor_paper_data/'
+
+def slice_reader(file_names, read_function, params):
+    return lambda z: read_function(file_names[z], **params)
+
+
+def convert_to_chunked_volume(purpose='train', path=None, chunk_shape=(1, 256, 256), compress=False):
+    '''Converts the tif images of one purpose into a chunked volume.
+
+    All channels of volume_channels whose directory has every gray image are
+    written with chunked_volume.write_volume, by default to
+    chunked_volume_path(purpose) where the samplers pick it up.
+
+    '''
+    pathPrefix = data_path_prefix()
+    if path is None:
+        path = chunked_volume_path(purpose)
+
+    gray_files = sorted( glob.glob( pathPrefix + 'images/' + purpose + '/*.tif' ) )
+    names = [os.path.basename(file_name) for file_name in gray_files]
+
+    channels = {}
+    for channel, directory, read_function, params in volume_channels:
+        file_names = [pathPrefix + directory + purpose + '/' + name for name in names]
+        if all(os.path.exists(file_name) for file_name in file_names):
+            channels[channel] = slice_reader(file_names, read_function, params)
+
+    write_volume(path, channels, len(names), chunk_shape, compress, names)
+
+
+def test_volume_path(pathPrefix):
+    # TestImages reads the test images from here if they were converted
+    return pathPrefix + 'volume/'
+
+
+def convert_test_volume(pathPrefix, path=None, chunk_shape=(1, 256, 256), compress=False):
+    '''Converts the test images pathPrefix/gray_images/*.tif into a chunked
+    volume, by default to test_volume_path(pathPrefix) where TestImages
+    picks it up.
+
+    The gray values are stored as they are, so tiles can be normalized
+    exactly like the whole slices. The saturation bounds of every slice and
+    of the whole stack go into the attributes of the volume.
+
+    '''
+    if path is None:
+        path = test_volume_path(pathPrefix)
+    img_files = sorted( glob.glob( pathPrefix + 'gray_images/*.tif' ) )
+
+    slice_bounds = []
+    def read_slices():
+        for img_file in img_files:
+            image = mahotas.imread(img_file)
+            slice_bounds.append([float(bound) for bound in saturation_bounds(image)])
+            yield image
+    volume_bounds = [float(bound) for bound in volume_saturation_bounds(read_slices())]
+
+    write_volume(path, {'gray': slice_reader(img_files, mahotas.imread, {})}, len(img_files), chunk_shape, compress,
+                 [os.path.basename(img_file) for img_file in img_files],
+                 {'saturation_bounds': {'slices': slice_bounds, 'volume': volume_bounds}})
+
+
+def reflected_indices(start, stop, size):
+    # positions start..stop of an axis of length size after padding it like
+    # np.pad(mode='reflect'), mapped back into the axis
+    if size == 1:
+        return np.zeros(stop - start, dtype=np.intp)
+    period = 2*(size - 1)
+    indices = np.arange(start, stop) % period
+    return np.where(indices < size, indices, period - indices)
+
+
+def reflected_window(start, stop, size):
+    # (part, (before, after)) with np.pad(axis[part], (before, after),
+    # mode='reflect') the positions start..stop of the axis of length size
+    # padded by reflection, None if that needs more than the part
+    low = min(max(start, 0), size)
+    high = max(min(stop, size), low)
+    before = low - start
+    after = stop - high
+    if (before or after) and max(before, after) >= high - low:
+        return None
+    return slice(low, high), (before, after)
+
+
+def mirror_borders(image, padding):
+    # fills the (before, after) borders of every axis of image in place with
+    # the reflection of its inside, like np.pad(inside, padding, mode='reflect')
+    for axis, (before, after) in enumerate(padding):
+        image = np.swapaxes(image, 0, axis)
+        stop = len(image) - after
+        if before:
+            image[:before] = image[2*before:before:-1]
+        if after:
+            end = stop - 2 - after
+            image[stop:] = image[stop - 2:end if end >= 0 else None:-1]
+        image = np.swapaxes(image, 0, axis)
+
+
+class NormalizedVolume(ChunkedVolume):
+    # a test volume of convert_test_volume with the additional channel
+    # 'normalized', its gray channel normalized to [0,1] with the saturation
+    # bounds of every slice (or of the whole volume). Chunks are normalized
+    # once when they are loaded, the chunk cache keeps them normalized
+    def __init__(self, path, normalize_per_volume=False):
+        ChunkedVolume.__init__(self, path)
+        bounds = self.attributes['saturation_bounds']
+        if normalize_per_volume:
+            self.bounds = [np.float32(bounds['volume'])] * self.shape[0]
+        else:
+            self.bounds = [np.float32(slice_bounds) for slice_bounds in bounds['slices']]
+        self.dtypes['normalized'] = np.dtype(np.float32)
+
+    def load_chunk(self, channel, chunk_index):
+        if channel != 'normalized':
+            return ChunkedVolume.load_chunk(self, channel, chunk_index)
+        first = chunk_index[0] * self.chunk_shape[0]
+        return np.array([normalizeImage(image, bounds=self.bounds[first + z])
+                         for z, image in enumerate(ChunkedVolume.load_chunk(self, 'gray', chunk_index))])
+
+
+class TestImages(object):
+    '''The test images below pathPrefix, read tile by tile by the inference loops.
+
+    The images come from the chunked volume test_volume_path(pathPrefix) if
+    it was converted with convert_test_volume, otherwise from
+    gray_images/*.tif. They are normalized to [0,1] with the saturation
+    bounds of their slice, or of the whole stack with normalize_per_volume.
+    A tile of the chunked volume only reads the chunks it overlaps, tif
+    images are decoded whole and kept in a slice cache.
+
+    '''
+    def __init__(self, pathPrefix, normalize_per_volume=False, volume_path=None):
+        if volume_path is None:
+            volume_path = test_volume_path(pathPrefix)
+
+        if is_volume(volume_path):
+            self.volume = NormalizedVolume(volume_path, normalize_per_volume)
+            self.names = self.volume.file_names
+            self.shape = self.volume.shape[1:]
+            return
+
+        self.volume = None
+        self.names = sorted( glob.glob( pathPrefix + 'gray_images/*.tif' ) )
+        bounds = None
+        if normalize_per_volume:
+            bounds = volume_saturation_bounds(mahotas.imread(img_file) for img_file in self.names)
+        def read_image(index):
+            with span('read', file=self.names[index]):
+                image = mahotas.imread(self.names[index])
+            return normalizeImage(image, bounds=bounds)
+        self.images = SliceStore(read_image, len(self.names), slice_cache_size())
+        self.shape = self.images[0].shape
+
+    def tile(self, index, row, col, size):
+        '''The size x size tile of image index with top left corner (row, col),
+        positions outside the image are mirrored like np.pad(mode='reflect').
+        For a list of images index, a (len(index), size, size) block.
+
+        '''
+        layers = [index] if np.isscalar(index) else list(index)
+        if self.volume is None and len(layers) > 1:
+            # keeps all of them in the slice cache
+            self.images.layers(layers)
+
+        tile = np.empty((len(layers), size, size), dtype=np.float32)
+        windows = [reflected_window(start, start + size, length) for start, length in zip((row, col), self.shape)]
+        for layer, layer_tile in zip(layers, tile):
+            if None not in windows:
+                (rows, (top, bottom)), (cols, (left, right)) = windows
+                layer_tile[top:size - bottom, left:size - right] = self.window(layer, rows, cols)
+                mirror_borders(layer_tile, [padding for part, padding in windows])
+            else:
+                # mirrored more than once, e.g. for tiles larger than the image
+                rows = reflected_indices(row, row + size, self.shape[0])
+                cols = reflected_indices(col, col + size, self.shape[1])
+                image = self.window(layer, slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1))
+                layer_tile[...] = image[np.ix_(rows - rows.min(), cols - cols.min())]
+        if np.isscalar(index):
+            return tile[0]
+        return tile
+
+    def window(self, index, rows, cols):
+        # window (rows, cols slices) of image index, normalized per pixel
+        if self.volume is None:
+            return self.images[index][rows, cols]
+        return self.volume.read('normalized', index, rows, cols)
+
+
+class AdjustedMembraneWindow(object):
+    # adjust_imprecise_boundaries on windows of a chunked volume. Labels only
+    # grow down and right, so adjusting the window plus number_iterations
+    # pixels above and left of it gives exactly the whole slice result
+    def __init__(self, volume, z, number_iterations):
+        self.volume = volume
+        self.z = z
+        self.number_iterations = number_iterations
+        self.shape = volume.shape[1:]
+
+    def __getitem__(self, key):
+        rows, cols = key[:2]
+        row_start, row_stop, step = rows.indices(self.shape[0])
+        col_start, col_stop, step = cols.indices(self.shape[1])
+        row_margin = min(self.number_iterations, row_start)
+        col_margin = min(self.number_iterations, col_start)
+        rows = slice(row_start - row_margin, row_stop)
+        cols = slice(col_start - col_margin, col_stop)
+        adjusted = adjust_imprecise_boundaries(self.volume.read('gray', self.z, rows, cols),
+                                               self.volume.read('membranes', self.z, rows, cols),
+                                               self.number_iterations)
+        return adjusted[row_margin:, col_margin:]
+
+
+def relabel(image):
+    image = image.copy()
+    id_list = np.unique(image)
+    for index, id in enumerate(id_list):
+        image[image==id] = index
+    return image
+
+
+def relabel_windows(windows, values):
+    # relabel for many patches at once, the rank of every values[i] among
+    # the distinct values of windows[i], (n, pixels) each
+    windows = np.sort(windows, axis=1).astype(np.int64)
+    ranks = np.zeros(windows.shape, dtype=np.int64)
+    ranks[:, 1:] = np.cumsum(windows[:, 1:] != windows[:, :-1], axis=1)
+
+    # one sorted key array, every window gets its own range of keys
+    lowest = windows.min()
+    key_offset = (windows.max() - lowest + 1) * np.arange(len(windows))[:, None]
+    positions = np.searchsorted((windows - lowest + key_offset).ravel(), values - lowest + key_offset)
+    return ranks.ravel()[positions]
+
+
+def patch_gatherer(source, rows, cols, patchSize):
+    '''gather(pixels, batch) returns the pixels (len(batch), k) of the
+    patches batch with top left corners (rows, cols) of source, as
+    (layers, len(batch), k).
+
+    pixels are flat indices into a patch, one row per patch, so flips,
+    rotations and deformations become a single take. Arrays and slice
+    stacks are gathered from directly. Windows of a chunked volume read
+    the bounding box of all patches at once or, when that covers more
+    pixels, every patch window on its own.
+
+    '''
+    if isinstance(source, np.ndarray):
+        images = [source]
+    elif isinstance(source, LayerWindow):
+        images = source.slices
     else:
-        pathPrefix = '/n/pfister_lab/vkaynig/'
+        top, left = rows.min(), cols.min()
+        height = rows.max() + patchSize - top
+        width = cols.max() + patchSize - left
+        if height*width <= len(rows)*patchSize**2:
+            block = source[top:top+height, left:left+width]
+            images = [block] if block.ndim == 2 else list(block)
+            rows, cols = rows - top, cols - left
+        else:
+            windows = np.array([source[row:row+patchSize, col:col+patchSize] for row, col in zip(rows, cols)])
+            if windows.ndim == 3:
+                windows = windows[:, None]
+            # the windows of a layer are stacked into one tall image
+            images = [np.ascontiguousarray(windows[:, layer]).reshape(-1, patchSize) for layer in xrange(windows.shape[1])]
+            rows, cols = np.arange(len(rows))*patchSize, np.zeros(len(rows), dtype=np.int64)
+
+    width = images[0].shape[1]
+    starts = (np.int64(rows)*width + cols)[:, None]
+    # offset of every patch pixel from the top left corner in the flat image
+    pixel_offsets = np.arange(patchSize)[:, None]*width + np.arange(patchSize)
+    pixel_offsets = pixel_offsets.ravel()
+    flat_images = [np.ravel(image) for image in images]
+
+    def gather(pixels, batch=slice(None)):
+        index = starts[batch] + pixel_offsets.take(pixels)
+        return np.array([image.take(index) for image in flat_images])
+    return gather
+
+
+def augmented_patches(img, membrane_img, label_img, rows, cols, codes, fields, patchSize, outPatchSize, batch_size=1024):
+    '''Patches with top left corners (rows, cols), flipped and rotated by
+    codes (flip*4 + rotation, see dihedral_indices) and deformed with the
+    fields of displacement_bank, gathered batch_size patches at a time.
+
+    Same result as cutting every patch, np.fliplr, np.rot90, relabel and
+    deform_layers one by one. Yields (batch, patches, membranes, labels):
+    the gray patches (len(batch), layers, pixels) divided by their maximum
+    in float32, the membranes and (if label_img is given) the labels
+    cropped to outPatchSize, both (len(batch), pixels) int32.
+
+    '''
+    bank = displacement_bank((patchSize, patchSize))
+    bank_index = np.array([field[0] for field in bank])
+    bank_rows_fraction = np.array([field[1] for field in bank])
+    bank_cols_fraction = np.array([field[2] for field in bank])
+    all_dihedral = dihedral_indices(patchSize)
+
+    offset = int(np.ceil((patchSize - outPatchSize) / 2.0))
+    crop = np.arange(offset, offset + outPatchSize)
+    crop = (crop[:, None]*patchSize + crop).ravel()
+
+    with span('read', patches=len(rows)):
+        gather_img = patch_gatherer(img, rows, cols, patchSize)
+        gather_membranes = patch_gatherer(membrane_img, rows, cols, patchSize)
+        if label_img is not None:
+            gather_labels = patch_gatherer(label_img, rows, cols, patchSize)
+
+    for start in xrange(0, len(rows), batch_size):
+        batch = slice(start, min(start + batch_size, len(rows)))
+        # flips, rotations and the deformation are one gather, so they are a single span
+        with span('augment', patches=batch.stop - batch.start):
+            flat_index = bank_index[fields[batch]]
+            rows_fraction = bank_rows_fraction[fields[batch]].astype(np.float32)
+            cols_fraction = bank_cols_fraction[fields[batch]].astype(np.float32)
+            dihedral = all_dihedral[codes[batch]]
+            patch_index = np.arange(len(dihedral))[:, None]
+
+            # gray values are interpolated between the four neighbours of the
+            # source pixel, looked up in the flipped and rotated patch
+            with span('deform'):
+                top = as_uint8(gather_img(dihedral[patch_index, flat_index], batch)).astype(np.float32)
+                top += (as_uint8(gather_img(dihedral[patch_index, flat_index + 1], batch)) - top) * cols_fraction
+                bottom = as_uint8(gather_img(dihedral[patch_index, flat_index + patchSize], batch)).astype(np.float32)
+                bottom += (as_uint8(gather_img(dihedral[patch_index, flat_index + patchSize + 1], batch)) - bottom) * cols_fraction
+                top += (bottom - top) * rows_fraction
+                patches = np.round(top).transpose(1, 0, 2)
+                patches /= patches.reshape(len(patches), -1).max(axis=1)[:, None, None]
+
+            # membranes and labels take the nearest pixel, only inside the crop
+            nearest = (flat_index + (rows_fraction >= 0.5)*patchSize + (cols_fraction >= 0.5))[:, crop]
+            nearest = dihedral[patch_index, nearest]
+            membranes = np.int32(gather_membranes(nearest, batch)[0] > 0)
+
+            labels = None
+            if label_img is not None:
+                windows = gather_labels(np.arange(patchSize**2)[None], batch)[0]
+                labels = np.int32(np.uint8(relabel_windows(windows, gather_labels(nearest, batch)[0])))
+        yield batch, patches, membranes, labels
+
+
+def sampled_images(nr_images, nsamples, rng=np.random):
+    # the samplers visit the images in order, all of them when there are at
+    # least as many samples as images. Fewer samples (e.g. single minibatches)
+    # come from a random subset, so they still cover the whole volume
+    if nsamples >= nr_images:
+        return xrange(nr_images)
+    return np.sort(rng.permutation(nr_images)[:nsamples])
+
+
+# samplers already set up in this process, with their slice caches,
+# see get_resident_sampler
+resident_samplers = {}
+
+
+def get_resident_sampler(sampler_class, purpose='train', *args):
+    # the first call in a process sets up the sampler, all later calls
+    # (e.g. every epoch in the data worker of the training scripts) reuse it
+    key = (sampler_class.__name__, purpose) + args
+    if key not in resident_samplers:
+        resident_samplers[key] = sampler_class(purpose, *args)
+    return resident_samplers[key]
+
+
+class SupervisedPatchSampler(object):
+    '''Membrane and background samples for the patch classifiers.
+
+    Slices of the volume of one purpose are decoded once and loaded on
+    first access into a bounded slice cache (see lazy_stack), sample()
+    only draws the patches. A chunked volume of the purpose (see
+    convert_to_chunked_volume) is used instead of the tif images if it exists.
+
+    '''
+    def __init__(self, purpose='train'):
+        self.purpose = purpose
+        pathPrefix = data_path_prefix()
+
+        if is_volume(chunked_volume_path(purpose)):
+            volume = ChunkedVolume(chunked_volume_path(purpose))
+            self.img_files_gray = volume.file_names
+            index_files = [chunked_volume_path(purpose) + 'index.json']
+            volume_slices = lambda channel: SliceStore(lambda z: volume.read(channel, z), len(volume.file_names), slice_cache_size())
+            self.grayImages = volume_slices('gray')
+            self.membraneIndex = ClassIndex('membrane_index', index_files, lambda: volume_slices('membranes_nonDilate'))
+            self.backgroundIndex = ClassIndex('background_index', index_files, lambda: volume_slices('background'))
+            return
+
+        img_search_string_membraneImages = pathPrefix + 'labels/membranes_nonDilate/' + purpose + '/*.tif'
+        img_search_string_backgroundMaskImages = pathPrefix + 'labels/background_nonDilate/' + purpose + '/*.tif'
+        img_search_string_grayImages = pathPrefix + 'images/' + purpose + '/*.tif'
+
+        self.img_files_gray = sorted( glob.glob( img_search_string_grayImages ) )
+        self.img_files_label = sorted( glob.glob( img_search_string_membraneImages ) )
+        self.img_files_backgroundMask = sorted( glob.glob( img_search_string_backgroundMaskImages ) )
+
+        # decoded and normalized only once by the cache, loaded slice by slice
+        self.grayImages = lazy_stack('gray', self.img_files_gray, read_normalized_image, {'saturation_level': 0.05})
+        # membrane and background pixels are only kept as coordinate indices,
+        # the masks are read when an index is built for the first time
+        self.membraneIndex = ClassIndex('membrane_index', self.img_files_label,
+                                        lambda: lazy_stack('membranes', self.img_files_label, read_binary_image))
+        self.backgroundIndex = ClassIndex('background_index', self.img_files_backgroundMask,
+                                          lambda: lazy_stack('background', self.img_files_backgroundMask, read_binary_image))
+
+    @traced('sample')
+    def sample(self, nsamples=1000, patchSize=29, balanceRate=0.5, rng=np.random):
+        whole_set_patches = np.zeros((nsamples, patchSize*patchSize), dtype=np.float32)
+        whole_set_labels = np.zeros(nsamples, dtype=np.int32)
+
+        #how many samples per image?
+        nsamples_perImage = np.uint(np.ceil(
+                (nsamples) / np.float(np.shape(self.img_files_gray)[0])
+                ))
+        counter = 0
+
+        # augmentation is drawn for all samples up front
+        angles = rng.randint(360, size=nsamples)
+        flips = rng.rand(nsamples) < 0.5
+        rotations = rng.randint(4, size=nsamples)
+
+        # exactly balanceRate of all samples are membrane samples, spread
+        # randomly over the images
+        positives = rng.permutation(nsamples) < int(round(balanceRate*nsamples))
+        # the samples of an image are written straight to their shuffled
+        # rows, so the output is never copied or sorted afterwards
+        positions = rng.permutation(nsamples)
 
-    img_search_string_membraneImages = pathPrefix + 'labels/membranes_nonDilate/' + purpose + '/*.tif'
-    img_search_string_backgroundMaskImages = pathPrefix + 'labels/background_nonDilate/' + purpose + '/*.tif'
-	
-    img_search_string_grayImages = pathPrefix + 'images/' + purpose + '/*.tif'
-	
-    img_files_gray = sorted( glob.glob( img_search_string_grayImages ) )
-    img_files_label = sorted( glob.glob( img_search_string_membraneImages ) )
-    img_files_backgroundMask = sorted( glob.glob( img_search_string_backgroundMaskImages ) )
-	
-    whole_set_patches = np.zeros((nsamples, patchSize*patchSize), dtype=np.float)
-    whole_set_labels = np.zeros(nsamples, dtype=np.int32)
-	
-    #how many samples per image?
-    nsamples_perImage = np.uint(np.ceil( 
-		(nsamples) / np.float(np.shape(img_files_gray)[0])
-	)) 
-    print 'using ' + np.str(nsamples_perImage) + ' samples per image.'
-    counter = 0
-	
-    img = mahotas.imread(img_files_gray[0])
-    grayImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-    labelImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-    maskImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-	
-    for img_index in xrange(np.shape(img_files_gray)[0]):
-        img = mahotas.imread(img_files_gray[img_index])
-        img = normalizeImage(img) 
-        grayImages[:,:,img_index] = img
-        label_img = mahotas.imread(img_files_label[img_index])        
-        labelImages[:,:,img_index] = label_img
-        mask_img = mahotas.imread(img_files_backgroundMask[img_index])
-        maskImages[:,:,img_index] = mask_img
-		
-    for img_index in xrange(np.shape(img_files_gray)[0]):
-        img = grayImages[:,:,img_index]        
-        label_img = labelImages[:,:,img_index]
-        mask_img = maskImages[:,:,img_index]
-		
         #get rid of invalid image borders
         border_patch = np.int(np.ceil(patchSize/2.0))
         border = np.int(np.ceil(np.sqrt(2*(border_patch**2))))
-        label_img[:border,:] = 0 #top
-        label_img[-border:,:] = 0 #bottom
-        label_img[:,:border] = 0 #left
-        label_img[:,-border:] = 0 #right
-		
-        mask_img[:border,:] = 0
-        mask_img[-border:,:] = 0
-        mask_img[:,:border] = 0
-        mask_img[:,-border:] = 0
-		
-        membrane_indices = np.nonzero(label_img)
-        non_membrane_indices = np.nonzero(mask_img)
-		
-        positiveSample = True
-        for i in xrange(nsamples_perImage):
-            if counter >= nsamples:
-                break
-            if positiveSample:
-                randmem = random.choice(xrange(len(membrane_indices[0])))
-                (row,col) = (membrane_indices[0][randmem], 
-                             membrane_indices[1][randmem])
-                label = 1.0
-                positiveSample = False
-            else:
-                randmem = random.choice(xrange(len(non_membrane_indices[0])))
-                (row,col) = (non_membrane_indices[0][randmem], 
-                             non_membrane_indices[1][randmem])
-                label = 0.0
-                positiveSample = True
-				
-            imgPatch = img[row-border+1:row+border, col-border+1:col+border]
-            imgPatch = skimage.transform.rotate(imgPatch, random.choice(xrange(360)))
-            imgPatch = imgPatch[border-border_patch:border+border_patch-1,border-border_patch:border+border_patch-1]
-
-            if random.random() < 0.5:
-                imgPatch = np.fliplr(imgPatch)
-            imgPatch = np.rot90(imgPatch, random.randint(0,3))
-                
-            whole_set_patches[counter,:] = imgPatch.flatten()
-            whole_set_labels[counter] = label
-            counter += 1
-            
-    #normalize data
-    whole_data = np.float32(whole_set_patches)
-	
-    whole_data = whole_data - 0.5
-	
-    data = whole_data.copy()
-    labels = whole_set_labels.copy()
-	
-    #remove the sorting in image order
-    shuffleIndex = rng.permutation(np.shape(labels)[0])
-    for i in xrange(np.shape(labels)[0]):  
-        whole_data[i,:] = data[shuffleIndex[i],:]
-        whole_set_labels[i] = labels[shuffleIndex[i]]
-		
-    data_set = (whole_data, whole_set_labels)    
-    
-    end_time = time.time()
-    total_time = (end_time - start_time)
-    print 'Running time: ' + '%.2fm' % (total_time / 60.)
-    rval = data_set
-    return rval
-
-
-def generate_image_data(img, patchSize=29, rows=1):
-    img = normalizeImage(img) 
-
-    # pad image borders
-    border = np.int(np.ceil(patchSize/2.0))
-    img_padded = np.pad(img, border, mode='reflect')
 
-    whole_set_patches = np.zeros((len(rows)*img.shape[1], patchSize**2))
+        for img_index in sampled_images(np.shape(self.img_files_gray)[0], nsamples, rng):
+            img = self.grayImages[img_index]
 
-    counter = 0
-    for row in rows:
-        for col in xrange(img.shape[1]):
-            imgPatch = img_padded[row+1:row+2*border, col+1:col+2*border]
-            whole_set_patches[counter,:] = imgPatch.flatten()
-            counter += 1
+            nsamples_img = int(min(nsamples_perImage, nsamples - counter))
+            if nsamples_img <= 0:
+                break
 
-    #normalize data
-    whole_set_patches = np.float32(whole_set_patches)
-    whole_set_patches = whole_set_patches - 0.5
+            positiveSample = positives[counter:counter + nsamples_img]
+            rows = np.zeros(nsamples_img, dtype=np.int)
+            cols = np.zeros(nsamples_img, dtype=np.int)
 
-    return whole_set_patches
+            rows[positiveSample], cols[positiveSample] = self.membraneIndex.draw(img_index, np.sum(positiveSample), border, rng)
+            rows[~positiveSample], cols[~positiveSample] = self.backgroundIndex.draw(img_index, np.sum(~positiveSample), border, rng)
 
+            batch = slice(counter, counter + nsamples_img)
+            imgPatches = rotate_patches(img, rows, cols, patchSize, angles[batch], flips[batch], rotations[batch])
+            with span('shuffle'):
+                target = positions[batch]
+                #normalize data
+                whole_set_patches[target] = np.reshape(imgPatches, (nsamples_img, -1)) - 0.5
+                whole_set_labels[target] = positiveSample
+            counter += nsamples_img
 
-def stupid_map_wrapper(parameters):
-        f = parameters[0]
-        args = parameters[1:]
-        return f(*args)
+        data_set = (whole_set_patches, whole_set_labels)
+        return data_set
 
 
-# changed the patch sampling to use upper left corner instead of middle pixel
-# for patch labels it doesn't matter and it makes sampling even and odd patches easier
-def generate_experiment_data_patch_prediction(purpose='train', nsamples=1000, patchSize=29, outPatchSize=1):
-    def relabel(image):
-        id_list = np.unique(image)
-        for index, id in enumerate(id_list):
-            image[image==id] = index
-        return image
+def generate_experiment_data_supervised(purpose='train', nsamples=1000, patchSize=29, balanceRate=0.5, rng=np.random):
+    sampler = get_resident_sampler(SupervisedPatchSampler, purpose)
+    return sampler.sample(nsamples, patchSize, balanceRate, rng)
 
-    start_time = time.time()
 
-    if os.path.exists('/media/vkaynig/Data1/Cmor_paper_data/'):
-        pathPrefix = '/media/vkaynig/Data1/Cmor_paper_data/'
-    else:
-        pathPrefix = '/n/pfister_lab/vkaynig/'
-
-    img_search_string_membraneImages = pathPrefix + 'labels/membranes_fullContour/' + purpose + '/train*.tif'
-    img_search_string_labelImages = pathPrefix + 'labels/' + purpose + '/train*.tif'
-    img_search_string_grayImages = pathPrefix + 'images/' + purpose + '/train*.tif'
-
-    img_files_gray = sorted( glob.glob( img_search_string_grayImages ) )
-    img_files_membrane = sorted( glob.glob( img_search_string_membraneImages ) )
-    img_files_labels = sorted( glob.glob( img_search_string_labelImages ) )
-
-    whole_set_patches = np.zeros((nsamples, patchSize**2), dtype=np.float)
-    whole_set_labels = np.zeros((nsamples, outPatchSize**2), dtype=np.int32)
-    whole_set_membranes = np.zeros((nsamples, outPatchSize**2), dtype=np.int32)
-
-    #how many samples per image?
-    nsamples_perImage = np.uint(np.ceil( 
-            (nsamples) / np.float(np.shape(img_files_gray)[0])
-            )) 
-    print 'using ' + np.str(nsamples_perImage) + ' samples per image.'
-    counter = 0
-
-    img = mahotas.imread(img_files_gray[0])
-    grayImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-    labelImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-    membraneImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-    maskImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-
-    # read the data
-    # in random order
-    read_order = np.random.permutation(np.shape(img_files_gray)[0])
-    for img_index in read_order:
-        #print img_files_gray[img_index]
-        img = mahotas.imread(img_files_gray[img_index])
-        # normalizes [0,1]
-        img = normalizeImage(img) 
-        grayImages[:,:,img_index] = img
-        membrane_img = mahotas.imread(img_files_membrane[img_index])/255.        
-        membraneImages[:,:,img_index] = membrane_img
-        maskImages[:,:,img_index] = 1.0
-        if purpose == 'validate':
-            label_img = mahotas.imread(img_files_labels[img_index])        
-            label_img = np.double(label_img)
-            labelImages[:,:,img_index] = label_img
-            
-    for img_index in xrange(np.shape(img_files_gray)[0]):
-        #print img_files_gray[read_order[img_index]]
-        img = grayImages[:,:,img_index]        
-        label_img = labelImages[:,:,img_index]
-        membrane_img = membraneImages[:,:,img_index]
-        mask_img = maskImages[:,:,img_index]
-
-        if purpose=='train':
-           membrane_img = adjust_imprecise_boundaries(img, membrane_img, 1)
+def image_patch_view(img_padded, patchSize=29):
+    # read-only view of shape (rows, cols, size, size) holding the patch around
+    # every pixel of the unpadded image, nothing is copied
+    border = np.int(np.ceil(patchSize/2.0))
+    size = 2*border - 1
+    rows = img_padded.shape[0] - 2*border
+    cols = img_padded.shape[1] - 2*border
+    # patches start one pixel into the padding, same as the old per-pixel loop
+    origin = img_padded[1:, 1:]
+    view = np.lib.stride_tricks.as_strided(origin, shape=(rows, cols, size, size),
+                                           strides=origin.strides + origin.strides)
+    view.flags.writeable = False
+    return view
+
+
+def pad_image_data(img, patchSize=29, bounds=None):
+    # normalize, center and pad once, so patches can be cut out as views
+    img = normalizeImage(img, bounds=bounds) - 0.5
+    border = np.int(np.ceil(patchSize/2.0))
+    return np.pad(img, border, mode='reflect')
 
-        #get rid of invalid image borders
-        mask_img[:,-patchSize:] = 0
-        mask_img[-patchSize:,:] = 0
 
-        valid_indices = np.nonzero(mask_img)
+def generate_image_data(img, patchSize=29, rows=1, bounds=None):
+    img_padded = pad_image_data(img, patchSize, bounds)
+    patches = image_patch_view(img_padded, patchSize)
 
-        for i in xrange(nsamples_perImage):
-            
-            if counter >= nsamples:
-                break
+    # only the requested rows are copied out of the view
+    whole_set_patches = patches[np.asarray(rows)]
+    whole_set_patches = np.reshape(whole_set_patches, (-1, patches.shape[2]*patches.shape[3]))
 
-            randmem = random.choice(xrange(len(valid_indices[0])))
-            (row,col) = (valid_indices[0][randmem], 
-                         valid_indices[1][randmem])
-
-            imgPatch = img[row:row+patchSize, col:col+patchSize]
-            membranePatch = membrane_img[row:row+patchSize, col:col+patchSize]
-            labelPatch = label_img[row:row+patchSize, col:col+patchSize]
-
-            if random.random() < 0.5:
-                imgPatch = np.fliplr(imgPatch)
-                membranePatch = np.fliplr(membranePatch)
-                if purpose == 'validate':
-                    labelPatch = np.fliplr(labelPatch)
-
-            rotateInt = random.randint(0,3)
-            imgPatch = np.rot90(imgPatch, rotateInt)
-            membranePatch = np.rot90(membranePatch, rotateInt)
-            if purpose=='validate':
-                labelPatch = np.rot90(labelPatch, rotateInt)
-
-            if purpose=='validate':
-                labelPatch = relabel(labelPatch)
-                imgPatch, membranePatch, labelPatch = deform_images(imgPatch, membranePatch, np.uint8(labelPatch))
-            else:
-                imgPatch, membranePatch = deform_images(imgPatch, membranePatch)
-            
-            imgPatch = imgPatch / np.double(np.max(imgPatch))
-            membranePatch = membranePatch / np.double(np.max(membranePatch))
-
-            # crop labelPatch to potentially smaller output size
-            offset_small_patch = int(np.ceil((patchSize - outPatchSize) / 2.0))
-            membranePatch = membranePatch[offset_small_patch:offset_small_patch+outPatchSize, 
-                                    offset_small_patch:offset_small_patch+outPatchSize]
-            labelPatch = labelPatch[offset_small_patch:offset_small_patch+outPatchSize, 
-                                    offset_small_patch:offset_small_patch+outPatchSize]
-
-            whole_set_patches[counter,:] = imgPatch.flatten()
-            whole_set_labels[counter] = labelPatch.flatten()
-            whole_set_membranes[counter] = np.int32(membranePatch.flatten() > 0)
-            counter += 1
-
-    #normalize data
-    whole_data = np.float32(whole_set_patches)
-    whole_data = whole_data - 0.5
-
-    data = whole_data.copy()
-    labels = whole_set_labels.copy()
-    membranes = whole_set_membranes.copy()
-
-    #remove the sorting in image order
-    shuffleIndex = np.random.permutation(np.shape(membranes)[0])
-    for i in xrange(np.shape(membranes)[0]):  
-        whole_data[i,:] = data[shuffleIndex[i],:]
-        whole_set_labels[i,:] = labels[shuffleIndex[i],:]
-        whole_set_membranes[i,:] = membranes[shuffleIndex[i],:]
-    
-    if purpose == 'validate':
-        data_set = (whole_data, whole_set_membranes, whole_set_labels)    
-    else:
-        data_set = (whole_data, whole_set_membranes)    
+    return whole_set_patches
 
-    end_time = time.time()
-    total_time = (end_time - start_time)
-    print 'Running time: ', total_time / 60.
-    print 'finished sampling data'
 
-    return data_set
+def generate_image_data_chunks(img, patchSize=29, rows_per_chunk=16, bounds=None):
+    # generator version of generate_image_data for whole images
+    # yields (rows, patches) with at most rows_per_chunk image rows per chunk,
+    # so memory stays bounded independent of the image size
+    img_padded = pad_image_data(img, patchSize, bounds)
+    patches = image_patch_view(img_padded, patchSize)
 
+    for row_start in xrange(0, patches.shape[0], rows_per_chunk):
+        rows = np.arange(row_start, min(row_start+rows_per_chunk, patches.shape[0]))
+        chunk = np.reshape(patches[row_start:rows[-1]+1], (-1, patches.shape[2]*patches.shape[3]))
+        yield rows, chunk
 
 
-def generate_experiment_data_patch_prediction_layers(purpose='train', nsamples=1000, patchSize=29, outPatchSize=1, nr_layers=3):
-    def relabel(image):
-        id_list = np.unique(image)
-        for index, id in enumerate(id_list):
-            image[image==id] = index
-        return image
+def stupid_map_wrapper(parameters):
+        f = parameters[0]
+        args = parameters[1:]
+        return f(*args)
 
-    start_time = time.time()
 
-    if os.path.exists('/media/vkaynig/Data1/Cmor_paper_data/'):
-        pathPrefix = '/media/vkaynig/Data1/Cmor_paper_data/'
-    else:
-        pathPrefix = '/n/pfister_lab/vkaynig/'
-
-    img_search_string_membraneImages = pathPrefix + 'labels/membranes_fullContour/' + purpose + '/*.tif'
-    img_search_string_labelImages = pathPrefix + 'labels/' + purpose + '/*.tif'
-    img_search_string_grayImages = pathPrefix + 'images/' + purpose + '/*.tif'
-
-    img_files_gray = sorted( glob.glob( img_search_string_grayImages ) )
-    img_files_membrane = sorted( glob.glob( img_search_string_membraneImages ) )
-    img_files_labels = sorted( glob.glob( img_search_string_labelImages ) )
-
-    whole_set_patches = np.zeros((nsamples, nr_layers, patchSize**2), dtype=np.float)
-    whole_set_labels = np.zeros((nsamples, outPatchSize**2), dtype=np.int32)
-    whole_set_membranes = np.zeros((nsamples, outPatchSize**2), dtype=np.int32)
-
-    #how many samples per image?
-    nsamples_perImage = np.uint(np.ceil( 
-            (nsamples) / np.float(np.shape(img_files_gray)[0])
-            )) 
-    print 'using ' + np.str(nsamples_perImage) + ' samples per image.'
-    counter = 0
-
-    img = mahotas.imread(img_files_gray[0])
-    grayImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-    labelImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-    membraneImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-    maskImages = np.zeros((img.shape[0],img.shape[1], np.shape(img_files_gray)[0]))
-
-    # read the data
-    # in random order
-    #read_order = np.random.permutation(np.shape(img_files_gray)[0])
-    for img_index in range(np.shape(img_files_gray)[0]):
-        #print img_files_gray[img_index]
-        img = mahotas.imread(img_files_gray[img_index])
-        # normalizes [0,1]
-        img = normalizeImage(img) 
-        grayImages[:,:,img_index] = img
-        membrane_img = mahotas.imread(img_files_membrane[img_index])/255.        
-        membraneImages[:,:,img_index] = membrane_img
-        maskImages[:,:,img_index] = 1.0
+# changed the patch sampling to use upper left corner instead of middle pixel
+# for patch labels it doesn't matter and it makes sampling even and odd patches easier
+class PatchSampler(object):
+    '''Gray, membrane and (for validation) label volume for the patch prediction networks.
+
+    Slices of the volume of one purpose are decoded once and loaded on
+    first access into a bounded slice cache (see lazy_stack), sample()
+    only draws the patches. file_pattern selects the slices, e.g. 'train*.tif'.
+    If the purpose was converted with convert_to_chunked_volume, patches are
+    read as windows of the chunked volume instead, touching only the chunks
+    they overlap.
+
+    '''
+    def __init__(self, purpose='train', file_pattern='*.tif'):
+        self.purpose = purpose
+        pathPrefix = data_path_prefix()
+
+        self.volume = None
+        if is_volume(chunked_volume_path(purpose)):
+            self.volume = ChunkedVolume(chunked_volume_path(purpose))
+            self.volume_slices = [z for z, name in enumerate(self.volume.file_names) if fnmatch.fnmatch(name, file_pattern)]
+            self.img_files_gray = [self.volume.file_names[z] for z in self.volume_slices]
+            self.slice_shape = self.volume.shape[1:]
+            return
+
+        img_search_string_membraneImages = pathPrefix + 'labels/membranes_fullContour/' + purpose + '/' + file_pattern
+        img_search_string_labelImages = pathPrefix + 'labels/' + purpose + '/' + file_pattern
+        img_search_string_grayImages = pathPrefix + 'images/' + purpose + '/' + file_pattern
+
+        self.img_files_gray = sorted( glob.glob( img_search_string_grayImages ) )
+        self.img_files_membrane = sorted( glob.glob( img_search_string_membraneImages ) )
+        self.img_files_labels = sorted( glob.glob( img_search_string_labelImages ) )
+
+        # read the data
+        # normalized [0,1], decoded only once by the cache, loaded slice by slice
+        self.grayImages = lazy_stack('gray', self.img_files_gray, read_normalized_image, {'saturation_level': 0.05})
+        self.membraneImages = lazy_stack('membranes', self.img_files_membrane, read_binary_image)
         if purpose == 'validate':
-            label_img = mahotas.imread(img_files_labels[img_index])        
-            label_img = np.double(label_img)
-            labelImages[:,:,img_index] = label_img
-            
-    for img_index in xrange(np.shape(img_files_gray)[0]):
-        img_cs = int(np.floor(nr_layers/2))
-        img_valid_range_indices = np.clip(range(img_index-img_cs,img_index+img_cs+1),0,np.shape(img_files_gray)[0]-1)
-        img = grayImages[:,:,img_valid_range_indices]     
-        label_img = labelImages[:,:,img_index]
-        membrane_img = membraneImages[:,:,img_index]
-        mask_img = maskImages[:,:,img_index]
-
-        if purpose=='train':
-            # adjust according to middle image
-            membrane_img = adjust_imprecise_boundaries(img[:,:,img_cs], membrane_img, 0)
-
-        #get rid of invalid image borders
-        mask_img[:,-patchSize:] = 0
-        mask_img[-patchSize:,:] = 0
-
-        valid_indices = np.nonzero(mask_img)
-
-        for i in xrange(nsamples_perImage):
-            
-            if counter >= nsamples:
+            self.labelImages = lazy_stack('labels', self.img_files_labels, read_label_image, dtype='smallest')
+        # membranes grown to the dark image pixels, see adjusted_membranes
+        self.adjustedMembranes = {}
+        self.slice_shape = self.grayImages[0].shape
+
+    def adjusted_membranes(self, number_iterations):
+        # adjust_imprecise_boundaries only depends on the volume, so each slice
+        # is adjusted once and cached on disk like the other slices instead
+        # of in every sample() call, or on every miss of the slice cache
+        if number_iterations not in self.adjustedMembranes:
+            def load_slice(index):
+                return cached_slice('adjusted_membranes', self.img_files_membrane[index], read_adjusted_membrane,
+                                    {'gray_file': self.img_files_gray[index], 'number_iterations': number_iterations},
+                                    sources=[self.img_files_gray[index]])
+            self.adjustedMembranes[number_iterations] = SliceStore(load_slice, len(self.membraneImages),
+                                                                   self.membraneImages.cache_size)
+        return self.adjustedMembranes[number_iterations]
+
+    def image_sources(self, img_index, layer_indices=None, number_iterations=None):
+        # gray, membrane and label image of img_index, either as arrays or as
+        # windows of the chunked volume, patches are cut from both the same way.
+        # layer_indices gives (layers, rows, cols) gray windows instead, with
+        # number_iterations the membranes are adjusted to the gray image
+        if self.volume is None:
+            if layer_indices is None:
+                img = self.grayImages[img_index]
+            else:
+                img = self.grayImages.layers(layer_indices)
+            if number_iterations is None:
+                membrane_img = self.membraneImages[img_index]
+            else:
+                membrane_img = self.adjusted_membranes(number_iterations)[img_index]
+            if self.purpose == 'validate':
+                label_img = self.labelImages[img_index]
+        else:
+            z = self.volume_slices[img_index]
+            if layer_indices is None:
+                img = VolumeWindow(self.volume, 'gray', z)
+            else:
+                img = VolumeWindow(self.volume, 'gray', [self.volume_slices[index] for index in layer_indices])
+            if number_iterations is None:
+                membrane_img = VolumeWindow(self.volume, 'membranes', z)
+            else:
+                membrane_img = AdjustedMembraneWindow(self.volume, z, number_iterations)
+            if self.purpose == 'validate':
+                label_img = VolumeWindow(self.volume, 'labels', z)
+
+        if self.purpose != 'validate':
+            label_img = np.zeros(self.slice_shape, dtype=np.uint8)
+        return img, membrane_img, label_img
+
+    @traced('sample')
+    def sample(self, nsamples=1000, patchSize=29, outPatchSize=1, nr_layers=None, rng=np.random, batch_size=1024,
+               importance=None):
+        # nr_layers=None samples single slices, otherwise nr_layers neighbouring
+        # slices are stacked into each patch
+        # all random draws go through rng (np.random or a RandomState)
+        # with an ImportanceMap, patch centers are drawn from it and their
+        # (image, row, col) are returned as an additional (nsamples, 3) array
+        if nr_layers is None:
+            patch_shape = (patchSize**2,)
+        else:
+            patch_shape = (nr_layers, patchSize**2)
+        whole_set_patches = np.empty((nsamples,) + patch_shape, dtype=np.float32)
+        whole_set_labels = np.empty((nsamples, outPatchSize**2), dtype=np.int32)
+        whole_set_membranes = np.empty((nsamples, outPatchSize**2), dtype=np.int32)
+        locations = np.empty((nsamples, 3), dtype=np.int32)
+
+        #how many samples per image?
+        nr_images = len(self.img_files_gray)
+        nsamples_perImage = np.uint(np.ceil( 
+                (nsamples) / np.float(nr_images)
+                )) 
+
+        # the samples of an image are written straight to their shuffled
+        # rows, so the output is never copied or sorted afterwards
+        positions = rng.permutation(nsamples)
+        counter = 0
+
+        for img_index in sampled_images(nr_images, nsamples, rng):
+            nr_patches = int(min(nsamples_perImage, nsamples - counter))
+            if nr_patches == 0:
                 break
 
-            randmem = random.choice(xrange(len(valid_indices[0])))
-            (row,col) = (valid_indices[0][randmem], 
-                         valid_indices[1][randmem])
-
-            imgPatch = img[row:row+patchSize, col:col+patchSize,:]
-            membranePatch = membrane_img[row:row+patchSize, col:col+patchSize]
-            labelPatch = label_img[row:row+patchSize, col:col+patchSize]
-
-            if random.random() < 0.5:
-                for flip_i in xrange(nr_layers):
-                    imgPatch[:,:,flip_i] = np.fliplr(imgPatch[:,:,flip_i])
-                membranePatch = np.fliplr(membranePatch)
-                if purpose == 'validate':
-                    labelPatch = np.fliplr(labelPatch)
-
-            rotateInt = random.randint(0,3)
-            for rot_i in xrange(nr_layers):
-                imgPatch[:,:,rot_i] = np.rot90(imgPatch[:,:,rot_i], rotateInt)
-            membranePatch = np.rot90(membranePatch, rotateInt)
-            if purpose=='validate':
-                labelPatch = np.rot90(labelPatch, rotateInt)
-
-            if purpose=='validate':
-                labelPatch = relabel(labelPatch)
-                deformed_images = deform_images_list(np.dstack([imgPatch*255, np.reshape(membranePatch*255,(patchSize,patchSize,1)), np.uint8(np.reshape(labelPatch,(patchSize,patchSize,1)))]))
-                imgPatch, membranePatch, labelPatch = np.split(deformed_images,[imgPatch.shape[2],imgPatch.shape[2]+1], axis=2)
+            if nr_layers is None:
+                layer_indices = None
+                number_iterations = 1
             else:
-                deformed_images = deform_images_list(np.dstack([imgPatch*255, np.reshape(membranePatch,(patchSize,patchSize,1))*255]))
-                imgPatch, membranePatch = np.split(deformed_images,[imgPatch.shape[2]], axis=2)            
-
-            imgPatch = imgPatch / np.double(np.max(imgPatch))
-            membranePatch = membranePatch / np.double(np.max(membranePatch))
-
-            # crop labelPatch to potentially smaller output size
-            offset_small_patch = int(np.ceil((patchSize - outPatchSize) / 2.0))
-            membranePatch = membranePatch[offset_small_patch:offset_small_patch+outPatchSize, 
-                                    offset_small_patch:offset_small_patch+outPatchSize]
-            labelPatch = labelPatch[offset_small_patch:offset_small_patch+outPatchSize, 
-                                    offset_small_patch:offset_small_patch+outPatchSize]
-
-            #whole_set_patches = np.zeros((nsamples, nr_layers, patchSize**2), dtype=np.float)
-            for patch_i in xrange(nr_layers):
-                whole_set_patches[counter,patch_i,:] = imgPatch[:,:,patch_i].flatten()
-            whole_set_labels[counter] = labelPatch.flatten()
-            whole_set_membranes[counter] = np.int32(membranePatch.flatten() > 0)
-            counter += 1
-
-    #normalize data
-    whole_data = np.float32(whole_set_patches)
-    whole_data = whole_data - 0.5
-
-    data = whole_data.copy()
-    labels = whole_set_labels.copy()
-    membranes = whole_set_membranes.copy()
-
-    #remove the sorting in image order
-    shuffleIndex = np.random.permutation(np.shape(membranes)[0])
-    for i in xrange(np.shape(membranes)[0]):  
-        whole_data[i,:,:] = data[shuffleIndex[i],:,:]
-        whole_set_labels[i,:] = labels[shuffleIndex[i],:]
-        whole_set_membranes[i,:] = membranes[shuffleIndex[i],:]
-    
-    if purpose == 'validate':
-        data_set = (whole_data, whole_set_membranes, whole_set_labels)    
-    else:
-        data_set = (whole_data, whole_set_membranes)    
-
-    end_time = time.time()
-    total_time = (end_time - start_time)
-    print 'Running time: ', total_time / 60.
-    print 'finished sampling data'
-
-    return data_set
+                img_cs = int(np.floor(nr_layers/2))
+                layer_indices = np.clip(range(img_index-img_cs,img_index+img_cs+1),0,nr_images-1)
+                # adjust according to middle image
+                number_iterations = 0
+            if self.purpose != 'train':
+                number_iterations = None
+            img, membrane_img, label_img = self.image_sources(img_index, layer_indices, number_iterations)
+            if self.purpose != 'validate':
+                label_img = None
+
+            #get rid of invalid image borders, patches start inside the
+            #rectangle [0, rows-patchSize) x [0, cols-patchSize)
+            valid_cols = self.slice_shape[1] - patchSize
+            valid_size = (self.slice_shape[0] - patchSize) * valid_cols
+
+            # coordinates, fliplr, rot90 and deformation of all patches of the image
+            if importance is None:
+                corners = rng.randint(valid_size, size=nr_patches)
+            else:
+                half = patchSize // 2
+                rows, cols = importance.draw(img_index, nr_patches, (half, half + self.slice_shape[0] - patchSize),
+                                             (half, half + valid_cols), rng)
+                corners = (rows - half)*valid_cols + cols - half
+            codes = np.int32(rng.rand(nr_patches) < 0.5)*4 + rng.randint(4, size=nr_patches)
+            fields = rng.randint(len(displacement_bank((patchSize, patchSize))), size=nr_patches)
+
+            for batch, patches, membranes, labels in augmented_patches(img, membrane_img, label_img,
+                    corners // valid_cols, corners % valid_cols, codes, fields, patchSize, outPatchSize, batch_size):
+                with span('shuffle'):
+                    target = positions[counter:][batch]
+                    #normalize data
+                    patches -= 0.5
+                    whole_set_patches[target] = patches.reshape((len(patches),) + patch_shape)
+                    whole_set_membranes[target] = membranes
+                    if labels is not None:
+                        whole_set_labels[target] = labels
+                    locations[target, 0] = img_index
+                    locations[target, 1] = corners[batch] // valid_cols + patchSize // 2
+                    locations[target, 2] = corners[batch] % valid_cols + patchSize // 2
+            counter += nr_patches
+
+        if self.purpose == 'validate':
+            data_set = (whole_set_patches, whole_set_membranes, whole_set_labels)    
+        else:
+            data_set = (whole_set_patches, whole_set_membranes)    
+        if importance is not None:
+            data_set += (locations,)
+
+        return data_set
+
+
+def generate_experiment_data_patch_prediction(purpose='train', nsamples=1000, patchSize=29, outPatchSize=1, rng=np.random,
+                                              importance=None):
+    sampler = get_resident_sampler(PatchSampler, purpose, 'train*.tif')
+    return sampler.sample(nsamples, patchSize, outPatchSize, rng=rng, importance=importance)
+
+
+def generate_experiment_data_patch_prediction_layers(purpose='train', nsamples=1000, patchSize=29, outPatchSize=1, nr_layers=3, rng=np.random,
+                                                     importance=None):
+    sampler = get_resident_sampler(PatchSampler, purpose, '*.tif')
+    return sampler.sample(nsamples, patchSize, outPatchSize, nr_layers, rng, importance=importance)
 
 if __name__=="__main__":
     import uuid
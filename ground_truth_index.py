@@ -0,0 +1,101 @@
+import os
+import numpy as np
+import mahotas
+from contingency import ContingencyTable, count_pairs, dense_labels, distribution_terms
+
+# bump whenever the content of saved indices changes
+INDEX_VERSION = 1
+
+
+class GroundTruthIndex(object):
+    '''The parts of the metrics that only depend on a ground truth label
+    image (slice or volume), computed once for all predictions of it.
+
+    mask are the pixels that are scored (ground truth > 0), ids the ground
+    truth labels in mask and labels the index into ids of every masked
+    pixel (in the order of ground_truth[mask]). counts are the pixels of
+    every id, sum_of_squares and entropy the terms of their fractions in the
+    Rand and VI scores.
+
+    '''
+    def __init__(self, ground_truth=None):
+        if ground_truth is None:
+            return
+        self.mask = (ground_truth > 0)
+        self.ids, labels = dense_labels(ground_truth[self.mask].astype(np.int32).astype(np.int64))
+        self.labels = labels.astype(np.int32)
+        self.counts = np.bincount(self.labels, minlength=len(self.ids))
+        self.sum_of_squares, self.entropy = distribution_terms(self.counts)
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    def label_image(self):
+        # labels as an image, -1 outside of mask
+        image = np.full(self.mask.shape, -1, dtype=np.int32)
+        image[self.mask] = self.labels
+        return image
+
+    def table(self, prediction):
+        # ContingencyTable of the ground truth ids and prediction in mask
+        gt, pred, counts = count_pairs(self.labels, prediction[self.mask])
+        table = ContingencyTable()
+        table.add_table(self.ids[gt], pred, counts)
+        return table
+
+    def save(self, file_name, signature=None):
+        # written to a temporary file first, so readers never see half an index
+        tmp_name = file_name + '.' + str(os.getpid()) + '.tmp.npz'
+        np.savez_compressed(tmp_name, version=INDEX_VERSION, signature=np.array(signature or [], dtype=np.int64),
+                            mask=self.mask, ids=self.ids, labels=self.labels, counts=self.counts,
+                            terms=np.array([self.sum_of_squares, self.entropy]))
+        os.rename(tmp_name, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        index = cls()
+        with np.load(file_name) as saved:
+            index.mask = saved['mask']
+            index.ids = saved['ids']
+            index.labels = saved['labels']
+            index.counts = saved['counts']
+            index.sum_of_squares, index.entropy = saved['terms']
+        return index
+
+
+def as_ground_truth_index(ground_truth):
+    # label images are indexed on the fly, indices are used as they are
+    if isinstance(ground_truth, GroundTruthIndex):
+        return ground_truth
+    return GroundTruthIndex(ground_truth)
+
+
+def index_file(label_file):
+    return label_file + '.gtindex.npz'
+
+
+def file_signature(file_name):
+    stat = os.stat(file_name)
+    return [INDEX_VERSION, stat.st_size, int(stat.st_mtime)]
+
+
+def ground_truth_index(label_file):
+    '''GroundTruthIndex of the label image label_file, saved next to it on
+    the first call and loaded afterwards. A changed label file (size or
+    mtime) is indexed again, an unwritable directory only skips saving.
+
+    '''
+    signature = file_signature(label_file)
+    if os.path.exists(index_file(label_file)):
+        with np.load(index_file(label_file)) as saved:
+            current = saved['version'] == INDEX_VERSION and list(saved['signature']) == signature
+        if current:
+            return GroundTruthIndex.load(index_file(label_file))
+
+    index = GroundTruthIndex(mahotas.imread(label_file))
+    try:
+        index.save(index_file(label_file), signature)
+    except (IOError, OSError):
+        pass
+    return index
@@ -0,0 +1,51 @@
+import functools
+import numpy as np
+from parallel_sampler import ParallelSampler
+
+
+def one_hot(labels, nr_classes):
+    targets = np.zeros((len(labels), nr_classes), dtype=np.float32)
+    targets[np.arange(len(labels)), labels.astype(np.int64)] = 1
+    return targets
+
+
+def minibatch_generator(sample_function, purpose, batch_size, args=(), input_shape=(1, 29, 29),
+                        nr_classes=None, nr_workers=0, seed=0, importance=None):
+    '''Endless (inputs, targets) minibatches for model.fit_generator.
+
+    Every minibatch is sampled on its own with
+    sample_function(purpose, batch_size, *args, rng=rng), e.g.
+    generate_experiment_data_patch_prediction, so sampling overlaps with
+    training batch by batch and only a few batches are held in memory.
+    inputs are float32 of shape (batch_size,) + input_shape (NCHW). targets
+    are the float32 labels of the sampler, one-hot encoded if nr_classes is
+    given. With nr_workers > 0 the batches are sampled by a ParallelSampler.
+
+    With an ImportanceMap, patches are drawn from it and the minibatches are
+    (inputs, targets, locations), see ImportanceMap.update for feeding the
+    losses back. The map has to exist before the generator starts workers.
+
+    '''
+    if importance is not None:
+        sample_function = functools.partial(sample_function, importance=importance)
+    if nr_workers > 0:
+        sampler = ParallelSampler(sample_function, [purpose, batch_size] + list(args),
+                                  nr_workers=nr_workers, seed=seed)
+        next_batch = sampler.get
+    else:
+        rng = np.random.RandomState(seed)
+        next_batch = lambda: sample_function(purpose, batch_size, *args, rng=rng)
+
+    while True:
+        data = next_batch()
+        # copies, the generator's consumer may queue several batches while
+        # the shared memory views of the sampler are already reused
+        inputs = np.array(np.reshape(data[0], (-1,) + tuple(input_shape)), dtype=np.float32)
+        if nr_classes is None:
+            targets = np.array(data[1], dtype=np.float32)
+        else:
+            targets = one_hot(data[1], nr_classes)
+        if importance is None:
+            yield inputs, targets
+        else:
+            yield inputs, targets, np.array(data[-1])
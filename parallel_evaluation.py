@@ -0,0 +1,157 @@
+import os
+import sys
+import glob
+import time
+import multiprocessing
+import numpy as np
+import evaluation
+from ground_truth_index import ground_truth_index
+from results_store import ResultsStore
+
+# Evaluation of boundary predictions on all cores. Every (network, slice,
+# block of thresholds) is an independent task, tasks are handed to a
+# process pool and their results streamed back into the ResultsStore as
+# they finish. Thresholds of slices in the store already are skipped, the
+# scores and the written .pkl files are the same as
+# run_evaluation_boundary_predictions'.
+#
+#   python parallel_evaluation.py pathPrefix [nr_workers]
+#   python parallel_evaluation.py --benchmark pathPrefix [nr_workers ...]
+
+
+def threshold_index_blocks(threshold_blocks, indices=None):
+    # indices (default: all) of evaluation_thresholds in threshold_blocks parts
+    if indices is None:
+        indices = np.arange(len(evaluation.evaluation_thresholds))
+    blocks = np.array_split(indices, threshold_blocks)
+    return [block for block in blocks if len(block)]
+
+
+def evaluation_tasks(network_names, pathPrefix, threshold_blocks=1, store=None):
+    # (network name, slice index, threshold indices, ground truth file, prediction file)
+    # of the thresholds not in store
+    tasks = []
+    for network_name in network_names:
+        img_files_gt, img_files_pred = evaluation.evaluation_files(network_name, pathPrefix)
+        for slice_index, (gt_file, pred_file) in enumerate(zip(img_files_gt, img_files_pred)):
+            indices = None
+            if store is not None:
+                indices = evaluation.missing_thresholds(store, network_name, pred_file)
+            for block in threshold_index_blocks(threshold_blocks, indices):
+                tasks.append((network_name, slice_index, block, gt_file, pred_file))
+    return tasks
+
+
+def evaluate_task(task):
+    # runs in a worker process
+    network_name, slice_index, block, gt_file, pred_file = task
+    results = evaluation.evaluate_slice(gt_file, pred_file, evaluation.evaluation_thresholds[block])
+    return network_name, slice_index, block, results
+
+
+def evaluate_parallel(network_names, pathPrefix='./AC4_small/', nr_workers=None, threshold_blocks=1, tasks=None):
+    '''Yields (network name, slice index, threshold indices, results) of all
+    slices of the networks in the order they finish, results are the
+    metrics of the thresholds evaluation_thresholds[threshold indices].
+
+    Slices are evaluated in nr_workers processes (default: one per core).
+    The component sweep shares its work between the thresholds of a task,
+    threshold_blocks > 1 only pays off with more cores than slices. tasks
+    (of evaluation_tasks) default to all thresholds of all slices.
+
+    '''
+    if tasks is None:
+        tasks = evaluation_tasks(network_names, pathPrefix, threshold_blocks)
+    if not tasks:
+        return
+    # index every ground truth slice once, the workers load the saved indices
+    for gt_file in sorted(set(task[3] for task in tasks)):
+        ground_truth_index(gt_file)
+
+    pool = multiprocessing.Pool(nr_workers)
+    try:
+        for result in pool.imap_unordered(evaluate_task, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run_parallel_evaluation(network_names, pathPrefix='./AC4_small/', nr_workers=None, threshold_blocks=1,
+                            store=None):
+    '''run_evaluation_boundary_predictions for every network in network_names
+    on all cores. Scores go to store (default: evaluation.results_file) as
+    tasks finish, only thresholds of slices that are not in it yet are
+    evaluated. The .pkl of a network is written as soon as its last slice
+    is done.
+
+    '''
+    if store is None:
+        store = ResultsStore(evaluation.results_file(pathPrefix))
+    tasks = evaluation_tasks(network_names, pathPrefix, threshold_blocks, store)
+    pred_files = dict(((task[0], task[1]), task[4]) for task in tasks)
+    remaining = dict((network_name, 0) for network_name in network_names)
+    for task in tasks:
+        remaining[task[0]] += 1
+    for network_name in network_names:
+        if remaining[network_name] == 0:
+            print network_name, 'is already done'
+
+    # only the main process writes to store
+    for network_name, slice_index, block, results in evaluate_parallel(network_names, pathPrefix, nr_workers,
+                                                                        threshold_blocks, tasks):
+        store.insert(evaluation.score_rows(network_name, pred_files[network_name, slice_index],
+                                           evaluation.evaluation_thresholds[block], results))
+        remaining[network_name] -= 1
+        print network_name, 'slice', slice_index, 'done'
+        if remaining[network_name] == 0:
+            evaluation.save_evaluation(store, network_name, pathPrefix)
+            print network_name, 'is done'
+
+
+def benchmark(pathPrefix, worker_counts=None):
+    '''Times the serial run_evaluation_boundary_predictions of every network
+    in pathPrefix against the parallel driver with worker_counts workers.
+    Every run starts from an empty (in memory) store and writes the .pkl
+    files of all networks again.
+
+    '''
+    network_names = sorted(os.path.basename(path[:-1]) for path in
+                           glob.glob(pathPrefix + 'boundaryProbabilities/*/'))
+    if worker_counts is None:
+        worker_counts = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+
+    # the ground truth indices are saved by the first run, not timed
+    for network_name in network_names:
+        for gt_file in evaluation.evaluation_files(network_name, pathPrefix)[0]:
+            ground_truth_index(gt_file)
+
+    start = time.time()
+    for network_name in network_names:
+        evaluation.run_evaluation_boundary_predictions(network_name, pathPrefix, ResultsStore(':memory:'))
+    serial_seconds = time.time() - start
+    timings = [('serial', serial_seconds, 1.0)]
+    for nr_workers in worker_counts:
+        start = time.time()
+        run_parallel_evaluation(network_names, pathPrefix, nr_workers, store=ResultsStore(':memory:'))
+        seconds = time.time() - start
+        timings.append((str(nr_workers) + ' workers', seconds, serial_seconds / seconds))
+
+    print 'cores:', multiprocessing.cpu_count()
+    for name, seconds, speedup in timings:
+        print '%-12s %8.2fs %6.2fx' % (name, seconds, speedup)
+    return timings
+
+
+if __name__=="__main__":
+    if sys.argv[1] == '--benchmark':
+        benchmark(os.path.join(sys.argv[2], ''), [int(count) for count in sys.argv[3:]] or None)
+        sys.exit(0)
+
+    pathPrefix = os.path.join(sys.argv[1], '')
+    nr_workers = None
+    if len(sys.argv) > 2:
+        nr_workers = int(sys.argv[2])
+    network_names = [os.path.basename(path[:-1]) for path in glob.glob(pathPrefix + 'boundaryProbabilities/*/')]
+    run_parallel_evaluation(network_names, pathPrefix, nr_workers)
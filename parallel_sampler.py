@@ -0,0 +1,126 @@
+import Queue
+import atexit
+import itertools
+import traceback
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy as np
+import tracing
+
+
+class ParallelSampler(object):
+    '''Worker processes that fill a shared-memory ring of sample batches.
+
+    sample_function(*args, rng=rng) has to return a tuple of arrays with the
+    same shapes for every call, e.g. generate_experiment_data_patch_prediction.
+    Batch k is produced by worker k % nr_workers with that worker's own
+    RandomState seeded from (seed, worker index), so the sequence of batches
+    is reproducible for a given seed and worker count.
+
+    get() returns the next batch as views into shared memory, no copy and no
+    pickling. The views stay valid until the following get() call. An
+    exception in sample_function (or a worker that dies) is raised by get()
+    as a RuntimeError with the worker's traceback.
+
+    close() (also called at exit) lets the workers finish their batch and
+    save their trace spans before they stop.
+
+    '''
+    # seconds get() waits for a batch before it checks on the workers, and
+    # workers wait for a free slot before they check for close()
+    poll_interval = 0.5
+    # seconds close() gives a worker to stop before it is terminated
+    shutdown_timeout = 10
+
+    def __init__(self, sample_function, args=(), nr_workers=2, depth=2, seed=0):
+        self.sample_function = sample_function
+        self.args = tuple(args)
+        self.nr_workers = nr_workers
+        self.nr_slots = nr_workers * depth
+        self.rngs = [np.random.RandomState([seed, worker]) for worker in xrange(nr_workers)]
+
+        # the first batch is sampled here with worker 0's stream, it gives the
+        # array layout for the ring. Workers forked afterwards also share the
+        # already loaded sampling volume copy-on-write.
+        first_batch = self.sample_function(*self.args, rng=self.rngs[0])
+        self.layout = [(a.shape, a.dtype) for a in first_batch]
+
+        self.buffers = []
+        self.slots = []
+        for slot in xrange(self.nr_slots):
+            buffers = [multiprocessing.sharedctypes.RawArray('b', max(1, int(np.prod(shape))*dtype.itemsize))
+                       for shape, dtype in self.layout]
+            self.buffers.append(buffers)
+            self.slots.append(tuple(np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+                                    for buffer, (shape, dtype) in zip(buffers, self.layout)))
+
+        self.free = [multiprocessing.Semaphore(1) for slot in xrange(self.nr_slots)]
+        self.filled = [multiprocessing.Semaphore(0) for slot in xrange(self.nr_slots)]
+        self.errors = multiprocessing.Queue()
+        self.stopping = multiprocessing.Event()
+
+        self.free[0].acquire()
+        for target, source in zip(self.slots[0], first_batch):
+            target[...] = source
+        self.filled[0].release()
+
+        self.next_batch = 0
+        self.workers = []
+        for worker in xrange(nr_workers):
+            process = multiprocessing.Process(target=self.fill, args=(worker,))
+            process.daemon = True
+            process.start()
+            self.workers.append(process)
+        atexit.register(self.close)
+
+    def fill(self, worker):
+        # runs in the worker process, worker 0 already delivered batch 0
+        start = worker if worker > 0 else self.nr_workers
+        try:
+            for batch in itertools.count(start, self.nr_workers):
+                slot = batch % self.nr_slots
+                while not self.free[slot].acquire(True, self.poll_interval):
+                    if self.stopping.is_set():
+                        return
+                if self.stopping.is_set():
+                    return
+                data = self.sample_function(*self.args, rng=self.rngs[worker])
+                for target, source in zip(self.slots[slot], data):
+                    target[...] = source
+                self.filled[slot].release()
+        except Exception:
+            # exceptions do not always pickle, their traceback does
+            self.errors.put((worker, traceback.format_exc()))
+        finally:
+            tracing.save_worker()
+
+    def get(self):
+        # hand the slot of the previous batch back to its worker
+        if self.next_batch > 0:
+            self.free[(self.next_batch - 1) % self.nr_slots].release()
+
+        slot = self.next_batch % self.nr_slots
+        while not self.filled[slot].acquire(True, self.poll_interval):
+            self.check_workers()
+        self.next_batch += 1
+        return self.slots[slot]
+
+    def check_workers(self):
+        # raises the error of a failed worker in the training process
+        for worker, process in enumerate(self.workers):
+            if not process.is_alive():
+                try:
+                    worker, message = self.errors.get(True, self.poll_interval)
+                except Queue.Empty:
+                    message = 'exited with code %s\n' % process.exitcode
+                self.close()
+                raise RuntimeError('sampler worker %d failed:\n%s' % (worker, message))
+
+    def close(self):
+        self.stopping.set()
+        for process in self.workers:
+            process.join(self.shutdown_timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.workers = []
@@ -17,9 +17,9 @@ from keras.layers.convolutional import (
 )
 from keras.layers.normalization import BatchNormalization
 from generate_data import *
+from minibatches import minibatch_generator
 import sys
 import mahotas
-import multiprocessing
 import matplotlib
 import matplotlib.pyplot as plt
 
@@ -239,6 +239,7 @@ if __name__ == '__main__':
     train_samples = 50000
     val_samples = 10000
     learning_rate = 0.1
+    sampling_workers = 4
     rng = np.random.RandomState(7)
     
     doTrain = int(sys.argv[1])
@@ -267,25 +268,16 @@ if __name__ == '__main__':
         data_x_val = np.reshape(data_x_val, [-1, 1, 65, 65])
         data_y_val = data_val[1].astype(np.float32)
         
-        # start pool for data
-        print "Starting worker."
-        pool = multiprocessing.Pool(processes=1)
-        futureData = pool.apply_async(stupid_map_wrapper, [[generate_experiment_data_supervised,'train', train_samples, 65, 0.5, rng]])
+        # start workers for data
+        print "Starting workers."
+        batches = minibatch_generator(generate_experiment_data_supervised, 'train', 100, [65, 0.5],
+                                      input_shape=(1, 65, 65), nr_workers=sampling_workers, seed=7)
         
         best_val_loss_so_far = 100
         
         for epoch in xrange(10000):
-            print "Waiting for data."
-            data = futureData.get()
-            
-            data_x = data[0].astype(np.float32)
-            data_x = np.reshape(data_x, [-1, 1, 65, 65])
-            data_y = data[1].astype(np.float32)
-            
-            print "got new data"
-            futureData = pool.apply_async(stupid_map_wrapper, [[generate_experiment_data_supervised, 'train', train_samples, 65, 0.5, rng]])
-            
-            model.fit(data_x, data_y, batch_size=100, nb_epoch=1)
+            # minibatches are sampled while the network trains on the previous ones
+            model.fit_generator(batches, samples_per_epoch=train_samples, nb_epoch=1)
         
             validation_loss = model.evaluate(data_x_val, data_y_val, batch_size=100)
             print "validation loss ", validation_loss
@@ -314,14 +306,13 @@ if __name__ == '__main__':
         prob_img = np.zeros(image.shape)
         
         start_time = time.clock()
-        for rows in xrange(image.shape[0]):
-            patch_data = generate_image_data(image, patchSize=65, rows=[rows]).astype(np.float32)
+        for rows, patch_data in generate_image_data_chunks(image, patchSize=65, rows_per_chunk=10):
             patch_data = np.reshape(patch_data, [-1, 1, 65, 65])
             probs = model.predict(x=patch_data, batch_size = image.shape[0])[:,0]
-            prob_img[rows,:] = probs
+            prob_img[rows,:] = np.reshape(probs, (len(rows), image.shape[1]))
             
-            if rows%10==0:
-                print rows
+            if rows[0]%10==0:
+                print rows[0]
                 print "time so far: ", time.clock()-start_time
                 
         mahotas.imsave('keras_prediction_resnet_08.png', np.uint8(prob_img*255))
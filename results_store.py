@@ -0,0 +1,77 @@
+import sqlite3
+import numpy as np
+
+# Evaluation scores in one SQLite file, a row per (network, slice, threshold,
+# metric, alpha). Slices are added as they are evaluated and work already in
+# the store is skipped, aggregates are computed by SQLite.
+
+
+class ResultsStore(object):
+    '''Scores of boundary prediction evaluations.
+
+    insert() adds or replaces rows (network, slice, threshold, metric,
+    alpha, value), all rows of one call in one transaction. thresholds()
+    tells which thresholds of a slice are stored already. Undefined scores
+    (nan) are stored as NULL and left out of the means.
+
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS scores (network TEXT, slice TEXT, threshold REAL, '
+                                    'metric TEXT, alpha REAL, value REAL, '
+                                    'PRIMARY KEY (network, slice, threshold, metric, alpha))')
+
+    def insert(self, rows):
+        # sqlite does not know numpy scalars
+        rows = [(network, slice_name, float(threshold), metric, float(alpha), None if np.isnan(value) else float(value))
+                for network, slice_name, threshold, metric, alpha, value in rows]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def thresholds(self, network, slice_name):
+        # thresholds of a slice in the store, rows of a slice are inserted together
+        return set(row[0] for row in self.connection.execute(
+            'SELECT DISTINCT threshold FROM scores WHERE network = ? AND slice = ?', (network, slice_name)))
+
+    def networks(self):
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT network FROM scores ORDER BY network')]
+
+    def curves(self, network, metric, alpha):
+        '''(slices, thresholds, values) of a network, values[i, j] is the score
+        of slices[i] at thresholds[j] (nan where it is missing).
+
+        '''
+        rows = self.connection.execute('SELECT slice, threshold, value FROM scores WHERE network = ? AND metric = ? '
+                                       'AND alpha = ?', (network, metric, alpha)).fetchall()
+        slices = sorted(set(row[0] for row in rows))
+        thresholds = sorted(set(row[1] for row in rows))
+        values = np.full((len(slices), len(thresholds)), np.nan)
+        slice_index = dict((name, index) for index, name in enumerate(slices))
+        threshold_index = dict((threshold, index) for index, threshold in enumerate(thresholds))
+        for slice_name, threshold, value in rows:
+            if value is not None:
+                values[slice_index[slice_name], threshold_index[threshold]] = value
+        return slices, np.array(thresholds), values
+
+    def mean_curve(self, network, metric, alpha):
+        # (thresholds, mean over slices) of a network
+        rows = self.connection.execute('SELECT threshold, AVG(value) FROM scores WHERE network = ? AND metric = ? '
+                                       'AND alpha = ? GROUP BY threshold ORDER BY threshold',
+                                       (network, metric, alpha)).fetchall()
+        return np.array([row[0] for row in rows]), np.array([row[1] for row in rows], dtype=np.double)
+
+    def best_means(self, metric, alpha):
+        '''(network, threshold, mean) of every network at the threshold with
+        the highest mean score over its slices.
+
+        '''
+        # sqlite takes the other columns from the row of MAX()
+        return self.connection.execute(
+            'SELECT network, threshold, MAX(mean) FROM '
+            '(SELECT network, threshold, AVG(value) AS mean FROM scores WHERE metric = ? AND alpha = ? '
+            'GROUP BY network, threshold) GROUP BY network ORDER BY network', (metric, alpha)).fetchall()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,169 @@
+import os
+import shutil
+import multiprocessing.sharedctypes
+import numpy as np
+from volume_cache import cache_dir, cache_key
+
+
+def build_class_index(masks):
+    # masks[i] is the mask of image i (e.g. a SliceStore), returns the flat
+    # pixel index (within its image) of every class pixel, image by image and
+    # sorted, plus for every image and row the position of the first entry
+    rows, cols = masks[0].shape
+    n_images = len(masks)
+    coordinates = []
+    row_offsets = np.zeros((n_images, rows + 1), dtype=np.int64)
+    start = 0
+    for img_index in xrange(n_images):
+        flat = np.flatnonzero(masks[img_index]).astype(np.int32)
+        row_offsets[img_index] = start + np.searchsorted(flat, np.arange(rows + 1)*cols)
+        coordinates.append(flat)
+        start += len(flat)
+    return np.concatenate(coordinates), row_offsets
+
+
+class ClassIndex(object):
+    '''Coordinates of the pixels of one class in every image of a stack.
+
+    The index is built once from the masks returned by read_masks() and
+    stored in the volume cache directory, keyed like cached_slice by name and
+    the source files, so later runs only load it. The arrays are memory
+    mapped, every process only pages in the parts it draws from. draw()
+    samples coordinates uniformly from the class pixels away from the image
+    border with a constant expected cost per draw.
+
+    '''
+    def __init__(self, name, file_names, read_masks):
+        path = os.path.join(cache_dir(), name + '-' + cache_key(name, file_names) + '.index')
+
+        if not os.path.exists(path):
+            masks = read_masks()
+            coordinates, row_offsets = build_class_index(masks)
+            # written to a temporary directory first, so readers never see
+            # half an index
+            tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+            os.makedirs(tmp_path)
+            np.save(os.path.join(tmp_path, 'coordinates.npy'), coordinates)
+            np.save(os.path.join(tmp_path, 'row_offsets.npy'), row_offsets)
+            np.save(os.path.join(tmp_path, 'shape.npy'), np.array(masks[0].shape))
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another process stored the same index first
+                shutil.rmtree(tmp_path)
+
+        self.coordinates = np.load(os.path.join(path, 'coordinates.npy'), mmap_mode='r')
+        self.row_offsets = np.load(os.path.join(path, 'row_offsets.npy'), mmap_mode='r')
+        self.shape = tuple(np.load(os.path.join(path, 'shape.npy')))
+
+    def count(self, img_index):
+        return self.row_offsets[img_index, -1] - self.row_offsets[img_index, 0]
+
+    def draw(self, img_index, nsamples, border=0, rng=np.random):
+        '''(rows, cols) of nsamples class pixels of image img_index, drawn
+        uniformly from the pixels at least border pixels away from the edges.
+
+        The inner rows are one contiguous range of the index, pixels in the
+        left and right border columns are rejected and drawn again.
+
+        '''
+        rows, cols = self.shape
+        if nsamples == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        start = self.row_offsets[img_index, border]
+        end = self.row_offsets[img_index, rows - border]
+        if end <= start:
+            raise ValueError('no class pixels inside the border of image ' + str(img_index))
+
+        coordinates = np.zeros(nsamples, dtype=np.int32)
+        missing = np.arange(nsamples)
+        while len(missing) > 0:
+            drawn = self.coordinates[start + rng.randint(end - start, size=len(missing))]
+            drawn_cols = drawn % cols
+            valid = np.logical_and(drawn_cols >= border, drawn_cols < cols - border)
+            if not np.any(valid):
+                inner_cols = self.coordinates[start:end] % cols
+                if not np.any(np.logical_and(inner_cols >= border, inner_cols < cols - border)):
+                    raise ValueError('no class pixels inside the border of image ' + str(img_index))
+            coordinates[missing[valid]] = drawn[valid]
+            missing = missing[~valid]
+
+        return coordinates // cols, coordinates % cols
+
+
+class ImportanceMap(object):
+    '''Coarse per-slice importance of patch locations for hard-example sampling.
+
+    Every slice is divided into cells of cell_size pixels. The weight of a
+    cell is a running average (with factor decay) of the losses of recent
+    patches centered in it, see update(), or of a validation error map,
+    see update_from_error_map(). Cells start with weight 1, so cells that
+    were never seen are preferred over ones with a small loss.
+
+    draw() picks patch centers in proportion to the weights, mixed with a
+    uniform draw of weight floor, so every location keeps at least floor
+    times its uniform probability. The weights live in shared memory, so
+    sampling workers forked after the map was created (see ParallelSampler)
+    draw with the current weights.
+
+    '''
+    def __init__(self, nr_images, slice_shape, cell_size=64, floor=0.25, decay=0.5):
+        self.cell_size = cell_size
+        self.floor = floor
+        self.decay = decay
+        self.grid_shape = (nr_images, -(-slice_shape[0] // cell_size), -(-slice_shape[1] // cell_size))
+        buffer = multiprocessing.sharedctypes.RawArray('d', int(np.prod(self.grid_shape)))
+        self.weights = np.frombuffer(buffer, dtype=np.float64).reshape(self.grid_shape)
+        self.weights[...] = 1
+
+    def update(self, locations, losses):
+        # locations (n, 3) are (image, row, col) of patch centers as returned
+        # by the samplers, losses one value per patch or one for all of them
+        locations = np.asarray(locations, dtype=np.int64).reshape(-1, 3)
+        losses = np.zeros(len(locations)) + losses
+        cells = np.ravel_multi_index((locations[:, 0], locations[:, 1] // self.cell_size,
+                                      locations[:, 2] // self.cell_size), self.grid_shape)
+        sums = np.bincount(cells, losses, minlength=self.weights.size)
+        counts = np.bincount(cells, minlength=self.weights.size)
+        touched = counts > 0
+        weights = self.weights.reshape(-1)
+        weights[touched] = self.decay*weights[touched] + (1 - self.decay)*sums[touched]/counts[touched]
+
+    def update_from_error_map(self, img_index, error_map):
+        # error_map (rows, cols) of slice img_index, e.g. the absolute error
+        # of a prediction, averaged per cell
+        rows, cols = self.grid_shape[1:]
+        padded = np.full((rows*self.cell_size, cols*self.cell_size), np.nan)
+        padded[:error_map.shape[0], :error_map.shape[1]] = error_map
+        cell_errors = np.nanmean(padded.reshape(rows, self.cell_size, cols, self.cell_size), axis=(1, 3))
+        self.weights[img_index] = self.decay*self.weights[img_index] + (1 - self.decay)*cell_errors
+
+    def draw(self, img_index, nsamples, row_range, col_range, rng=np.random):
+        '''(rows, cols) of nsamples patch centers in image img_index, inside
+        [row_range[0], row_range[1]) x [col_range[0], col_range[1]).
+
+        A cell is picked in proportion to its weight times the area it has
+        inside the range, the center is uniform within that area.
+
+        '''
+        cell_start = np.arange(self.grid_shape[1]) * self.cell_size
+        row_start = np.maximum(cell_start, row_range[0])
+        row_length = np.maximum(np.minimum(cell_start + self.cell_size, row_range[1]) - row_start, 0)
+        cell_start = np.arange(self.grid_shape[2]) * self.cell_size
+        col_start = np.maximum(cell_start, col_range[0])
+        col_length = np.maximum(np.minimum(cell_start + self.cell_size, col_range[1]) - col_start, 0)
+
+        area = np.float64(row_length[:, None] * col_length[None, :])
+        probabilities = self.floor * area / area.sum()
+        weighted = self.weights[img_index] * area
+        if weighted.sum() > 0:
+            probabilities += (1 - self.floor) * weighted / weighted.sum()
+        else:
+            probabilities += (1 - self.floor) * area / area.sum()
+
+        cells = rng.choice(probabilities.size, size=nsamples, p=probabilities.ravel() / probabilities.sum())
+        cell_rows = cells // self.grid_shape[2]
+        cell_cols = cells % self.grid_shape[2]
+        rows = row_start[cell_rows] + np.int64(rng.rand(nsamples) * row_length[cell_rows])
+        cols = col_start[cell_cols] + np.int64(rng.rand(nsamples) * col_length[cell_cols])
+        return rows, cols
@@ -8,7 +8,7 @@ from keras.optimizers import SGD
 from keras.initializations import uniform
 from keras import backend as K
 from generate_data import *
-import multiprocessing
+from minibatches import minibatch_generator
 import sys
 import matplotlib
 import matplotlib.pyplot as plt
@@ -19,6 +19,7 @@ val_samples = 100
 
 learning_rate = 0.1
 patience = 2
+sampling_workers = 4
 
 doTrain = int(sys.argv[1])
 filename = 'thick_membranes'
@@ -67,33 +68,21 @@ if doTrain:
     data_y_val = np.zeros((data_y_inds.shape[0],2))
     data_y_val[np.arange(data_y_inds.shape[0]),data_y_inds] = 1
     
-    # start pool for data
-    print "Starting worker."
-    pool = multiprocessing.Pool(processes=1)
-    futureData = pool.apply_async(stupid_map_wrapper, [[generate_experiment_data_supervised,'train', train_samples, 65, 0.5, rng]])
+    # start workers for data
+    print "Starting workers."
+    # one hot encoding for keras
+    batches = minibatch_generator(generate_experiment_data_supervised, 'train', 100, [65, 0.5],
+                                  input_shape=(1, 65, 65), nr_classes=2, nr_workers=sampling_workers, seed=7)
     
     best_val_loss_so_far = 100
     patience_counter = 0
 
     for epoch in xrange(1000000000):
-        print "Waiting for data."
-        data = futureData.get()
-        #data = generate_experiment_data_supervised(purpose='train', nsamples=1000, patchSize=65, balanceRate=0.5, rng=np.random)
-        
-        data_x = data[0].astype(np.float32)
-        data_x = np.reshape(data_x, [-1, 1, 65, 65])
-        # need one hot encoding for keras
-        data_y_inds = data[1].astype(np.int64)
-        data_y = np.zeros((data_y_inds.shape[0],2))
-        data_y[np.arange(data_y_inds.shape[0]),data_y_inds] = 1
-
-        print "got new data"
-        futureData = pool.apply_async(stupid_map_wrapper, [[generate_experiment_data_supervised, 'train', train_samples, 65, 0.5, rng]])
-        
-        model.fit(data_x, data_y, batch_size=100, nb_epoch=1)
+        # minibatches are sampled while the network trains on the previous ones
+        model.fit_generator(batches, samples_per_epoch=train_samples, nb_epoch=1)
         
         print "current learning rate: ", model.optimizer.lr.get_value()
-        model.fit(data_x, data_y, batch_size=100, nb_epoch=1)
+        model.fit_generator(batches, samples_per_epoch=train_samples, nb_epoch=1)
 
         validation_loss = model.evaluate(data_x_val, data_y_val, batch_size=100)
         print "validation loss ", validation_loss
@@ -138,14 +127,13 @@ else:
     prob_img = np.zeros(image.shape)
     
     start_time = time.clock()
-    for rows in xrange(image.shape[0]):
-        patch_data = generate_image_data(image, patchSize=65, rows=[rows]).astype(np.float32)
+    for rows, patch_data in generate_image_data_chunks(image, patchSize=65, rows_per_chunk=10):
         patch_data = np.reshape(patch_data, [-1, 1, 65, 65])
         probs = model.predict(x=patch_data, batch_size = image.shape[0])[:,0]
-        prob_img[rows,:] = probs
+        prob_img[rows,:] = np.reshape(probs, (len(rows), image.shape[1]))
         
-        if rows%10==0:
-            print rows
+        if rows[0]%10==0:
+            print rows[0]
             print "time so far: ", time.clock()-start_time
             
     mahotas.imsave('keras_prediction_cnn_16.png', np.uint8(prob_img*255))
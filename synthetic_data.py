@@ -0,0 +1,175 @@
+import os
+import sys
+import numpy as np
+import mahotas
+import scipy.ndimage
+
+# Synthetic EM-like volumes in the directory layout of the real data, so the
+# samplers, training scripts and evaluation run without the lab's data:
+#
+#   images/<purpose>/train_NNNN.tif                        gray images
+#   labels/<purpose>/train_NNNN.tif                        cell ids, 0 on membranes
+#   labels/membranes_fullContour/<purpose>/train_NNNN.tif  dilated membranes
+#   labels/membranes_nonDilate/<purpose>/train_NNNN.tif    thin membranes
+#   labels/background_nonDilate/<purpose>/train_NNNN.tif   cell interiors
+#
+# and for inference and evaluation (see run_evaluation_boundary_predictions)
+#
+#   gray_images/NNNN.tif, labels/NNNN.tif
+#   boundaryProbabilities/<network>/NNNN.tif               fake predictions
+#
+# Point DATA_PATH at a training volume to have the samplers use it.
+
+
+class SyntheticVolume(object):
+    '''Voronoi-like cells running through a stack of slices.
+
+    Every cell grows from a seed that drifts slowly from slice to slice, so
+    cells are tubes through the volume like neurites. Cell boundaries are
+    bent by a smooth random warp, the same in every slice. Slices are
+    generated one at a time from the seeds, memory only depends on the
+    slice size, so full 1024x1024x100 stacks are no problem.
+
+    '''
+    def __init__(self, shape=(20, 512, 512), cell_size=40, membrane_width=3, seed=0):
+        self.shape = tuple(shape)
+        self.membrane_width = membrane_width
+        self.seed = seed
+        nr_slices, rows, cols = self.shape
+        rng = np.random.RandomState(seed)
+
+        nr_cells = max(2, int(rows*cols / float(cell_size**2)))
+        self.start = rng.rand(nr_cells, 2) * (rows, cols)
+        self.drift = rng.normal(scale=0.05*cell_size, size=(nr_cells, 2))
+        # a few bright and dark cell types
+        self.intensity = rng.choice([150, 170, 190, 210], size=nr_cells) + rng.randint(-10, 10, size=nr_cells)
+
+        grid_rows, grid_cols = np.mgrid[0:rows, 0:cols]
+        warp = [scipy.ndimage.gaussian_filter(rng.normal(size=(rows, cols)), sigma=cell_size/4.0) for axis in xrange(2)]
+        self.warped_rows = grid_rows + warp[0] * (0.15*cell_size / warp[0].std())
+        self.warped_cols = grid_cols + warp[1] * (0.15*cell_size / warp[1].std())
+
+    def labels(self, z):
+        # cell ids (from 1) of slice z, every pixel belongs to a cell
+        nr_slices, rows, cols = self.shape
+        centers = self.start + z*self.drift
+        centers[:, 0] = np.clip(centers[:, 0], 0, rows - 1)
+        centers[:, 1] = np.clip(centers[:, 1], 0, cols - 1)
+
+        seeds = np.zeros((rows, cols), dtype=np.int32)
+        seeds[np.int64(centers[:, 0]), np.int64(centers[:, 1])] = np.arange(1, len(centers) + 1)
+        nearest_rows, nearest_cols = scipy.ndimage.distance_transform_edt(seeds == 0, return_distances=False,
+                                                                          return_indices=True)
+        cells = seeds[nearest_rows, nearest_cols]
+        # curved instead of straight boundaries
+        return scipy.ndimage.map_coordinates(cells, [self.warped_rows, self.warped_cols], order=0, mode='nearest')
+
+    def slice(self, z):
+        '''(gray, cell ids, thin membranes, dilated membranes) of slice z.
+
+        The gray image has a brightness per cell, intracellular texture and
+        small dark organelles, dark membranes, blur and noise. Cell ids are 0
+        on the dilated membranes.
+
+        '''
+        rng = np.random.RandomState([self.seed, z, 1])
+        cells = self.labels(z)
+        membranes = np.zeros(cells.shape, dtype=bool)
+        membranes[:-1] |= cells[:-1] != cells[1:]
+        membranes[:, :-1] |= cells[:, :-1] != cells[:, 1:]
+        membranes_dilated = scipy.ndimage.binary_dilation(membranes, iterations=self.membrane_width // 2 + 1)
+
+        gray = self.intensity[cells - 1].astype(np.float32)
+        gray += scipy.ndimage.gaussian_filter(rng.normal(size=cells.shape), sigma=2) * 40
+        organelles = scipy.ndimage.gaussian_filter(rng.rand(*cells.shape), sigma=3)
+        gray -= 60 * (organelles > np.percentile(organelles, 97))
+        gray -= 120 * scipy.ndimage.gaussian_filter(np.float32(membranes_dilated), sigma=1)
+        gray = scipy.ndimage.gaussian_filter(gray, sigma=1)
+        gray += rng.normal(scale=12, size=cells.shape)
+
+        gray = np.uint8(np.clip(gray, 0, 255))
+        labels = np.uint16(cells * ~membranes_dilated)
+        return gray, labels, membranes, membranes_dilated
+
+
+def boundary_probabilities(gray, membranes, quality=0.8, rng=np.random):
+    '''Fake network output for a synthetic slice in [0,1], high inside cells
+    and low on the (dilated) membranes like the maps unet writes. quality 1
+    is the perfect membrane map, lower values blur it, open gaps in the
+    membranes and add noise and false boundaries at dark texture.
+
+    '''
+    probabilities = scipy.ndimage.gaussian_filter(np.float32(membranes), sigma=1 + 3*(1 - quality))
+
+    # gaps where the membrane is missed
+    gaps = scipy.ndimage.gaussian_filter(rng.rand(*membranes.shape), sigma=6)
+    probabilities *= gaps > np.percentile(gaps, 100*(1 - quality)*0.5)
+    # spurious boundaries
+    probabilities += (1 - quality) * (1 - gray / 255.0) * (rng.rand(*membranes.shape) < 0.5)
+    probabilities += rng.normal(scale=0.15*(1 - quality), size=membranes.shape)
+
+    return 1 - np.clip(probabilities / max(probabilities.max(), 1e-6), 0, 1)
+
+
+def make_directories(path, directories):
+    for directory in directories:
+        if not os.path.exists(path + directory):
+            os.makedirs(path + directory)
+
+
+def write_training_data(path, purposes=('train', 'validate'), shape=(20, 512, 512), seed=0):
+    '''Writes one synthetic volume per purpose below path in the layout the
+    samplers read (see data_path_prefix), every purpose has its own cells.
+
+    '''
+    for index, purpose in enumerate(purposes):
+        volume = SyntheticVolume(shape, seed=seed + index)
+        directories = ['images/' + purpose + '/', 'labels/' + purpose + '/',
+                       'labels/membranes_fullContour/' + purpose + '/',
+                       'labels/membranes_nonDilate/' + purpose + '/',
+                       'labels/background_nonDilate/' + purpose + '/']
+        make_directories(path, directories)
+
+        for z in xrange(shape[0]):
+            gray, labels, membranes, membranes_dilated = volume.slice(z)
+            name = 'train_' + str(z).zfill(4) + '.tif'
+            for directory, image in zip(directories, [gray, labels, np.uint8(membranes_dilated*255),
+                                                      np.uint8(membranes*255), np.uint8(~membranes_dilated*255)]):
+                mahotas.imsave(path + directory + name, image)
+
+
+def write_test_data(path, shape=(20, 512, 512), networks=(('synthetic_good', 0.9), ('synthetic_poor', 0.6)), seed=100):
+    '''Writes a synthetic test volume below path, gray_images/ for inference
+    and labels/ for the evaluation, plus fake boundaryProbabilities/ of the
+    given quality for every (network name, quality).
+
+    '''
+    volume = SyntheticVolume(shape, seed=seed)
+    make_directories(path, ['gray_images/', 'labels/'] +
+                     ['boundaryProbabilities/' + name + '/' for name, quality in networks])
+
+    for z in xrange(shape[0]):
+        gray, labels, membranes, membranes_dilated = volume.slice(z)
+        name = str(z).zfill(4) + '.tif'
+        mahotas.imsave(path + 'gray_images/' + name, gray)
+        mahotas.imsave(path + 'labels/' + name, labels)
+        for network_index, (network_name, quality) in enumerate(networks):
+            rng = np.random.RandomState([seed, z, network_index])
+            probabilities = boundary_probabilities(gray, membranes_dilated, quality, rng)
+            mahotas.imsave(path + 'boundaryProbabilities/' + network_name + '/' + name, np.uint8(probabilities*255))
+
+
+if __name__=="__main__":
+    # python synthetic_data.py path [nr_slices [size]]
+    path = os.path.join(sys.argv[1], '')
+    nr_slices = 20
+    size = 512
+    if len(sys.argv) > 2:
+        nr_slices = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        size = int(sys.argv[3])
+
+    write_training_data(path + 'training/', shape=(nr_slices, size, size))
+    write_test_data(path + 'testing/', shape=(nr_slices, size, size))
+    print 'training data in', path + 'training/', '(set DATA_PATH to use it)'
+    print 'test data in', path + 'testing/'
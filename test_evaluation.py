@@ -0,0 +1,161 @@
+import unittest
+import collections
+import numpy as np
+import mahotas
+from scipy.ndimage.filters import maximum_filter
+import synthetic_data
+from evaluation import (thin_boundaries, bounding_box, segmentation_metrics, segmentation_table, contingency_scores,
+                        threshold_sweep_metrics, quick_Rand, Rand, VI, score_alphas)
+from contingency import merge_tables
+from component_sweep import component_sweep
+
+# Regression tests of the evaluation against the loops it replaced, on
+# small synthetic volumes (see synthetic_data.py).
+#
+#   python -m unittest discover -p 'test_*.py'
+
+
+def synthetic_slices(nr_slices=3, size=96, quality=0.7, seed=0):
+    # (ground truth labels, boundary probabilities) of every slice
+    volume = synthetic_data.SyntheticVolume((nr_slices, size, size), cell_size=16, seed=seed)
+    slices = []
+    for z in xrange(nr_slices):
+        gray, labels, membranes, membranes_dilated = volume.slice(z)
+        rng = np.random.RandomState([seed, z])
+        slices.append((labels, synthetic_data.boundary_probabilities(gray, membranes_dilated, quality, rng)))
+    return slices
+
+
+def loop_thin_boundaries(im, mask):
+    # thin_boundaries as it was, growing all regions with 3x3 maximum filters
+    im = im.copy()
+    if np.sum(im) == 0:
+       im[:] = 1.0
+       im[0,:] = 2.0
+    while (im[mask] == 0).sum() > 0:
+        zeros = (im == 0)
+        im[zeros] = maximum_filter(im, 3)[zeros]
+    if len(np.unique(im))==1:
+        im[0,:] = 5
+    return im
+
+
+def loop_metrics(ground_truth, prediction):
+    # segmentation_metrics(..., seq=True) as it was, counting every pixel
+    counter_pairwise = collections.Counter()
+    counter_gt = collections.Counter()
+    counter_pred = collections.Counter()
+    for gt, pred in zip(ground_truth, prediction):
+        mask = (gt > 0)
+        pred = loop_thin_boundaries(pred, mask)
+        counter_pairwise.update(zip(gt[mask], pred[mask]))
+        counter_gt.update(gt[mask])
+        counter_pred.update(pred[mask])
+
+    fractions = []
+    for counter in (counter_pairwise, counter_gt, counter_pred):
+        counts = np.array(counter.values(), dtype=np.double)
+        fractions.append(counts / counts.sum())
+    return {'Rand': dict((k, Rand(fractions[0], fractions[1], fractions[2], v)) for k, v in score_alphas.items()),
+            'VI': dict((k, VI(fractions[0], fractions[1], fractions[2], v)) for k, v in score_alphas.items())}
+
+
+class ScoresTestCase(unittest.TestCase):
+
+    def assertScoresEqual(self, scores, expected):
+        for measure in ('Rand', 'VI'):
+            for k in score_alphas:
+                np.testing.assert_allclose(scores[measure][k], expected[measure][k], rtol=1e-9, err_msg=measure + ' ' + k)
+
+
+class ThinBoundariesTest(unittest.TestCase):
+
+    def assertThinnedLikeLoop(self, im, mask):
+        # pixels outside the bounding box of mask keep their label
+        box = bounding_box(mask)
+        np.testing.assert_array_equal(thin_boundaries(im, mask)[box], loop_thin_boundaries(im, mask)[box])
+
+    def test_slices(self):
+        for labels, probabilities in synthetic_slices():
+            for threshold in (0.2, 0.5, 0.9):
+                self.assertThinnedLikeLoop(mahotas.label(probabilities > threshold)[0], labels > 0)
+
+    def test_partial_mask(self):
+        labels, probabilities = synthetic_slices(1)[0]
+        mask = np.zeros(labels.shape, dtype=bool)
+        mask[30:50, 40:80] = labels[30:50, 40:80] > 0
+        self.assertThinnedLikeLoop(mahotas.label(probabilities > 0.5)[0], mask)
+
+    def test_volume(self):
+        slices = synthetic_slices(4)
+        labels = np.array([gt for gt, probabilities in slices])
+        probabilities = np.array([probabilities for gt, probabilities in slices])
+        self.assertThinnedLikeLoop(mahotas.label(probabilities > 0.5)[0], labels > 0)
+
+    def test_constant_images(self):
+        labels, probabilities = synthetic_slices(1)[0]
+        mask = labels > 0
+        self.assertThinnedLikeLoop(np.zeros(labels.shape, dtype=np.int32), mask)
+        self.assertThinnedLikeLoop(np.int32(probabilities > 0.5), mask)
+
+
+class ContingencyTableTest(ScoresTestCase):
+
+    def test_segmentation_metrics(self):
+        slices = synthetic_slices()
+        predictions = [mahotas.label(probabilities > 0.5)[0] for labels, probabilities in slices]
+        ground_truth = [labels for labels, probabilities in slices]
+        self.assertScoresEqual(segmentation_metrics(ground_truth, predictions, seq=True),
+                               loop_metrics(ground_truth, predictions))
+
+    def test_merged_tables(self):
+        # tables of single slices (e.g. from other processes) merged into one
+        slices = synthetic_slices()
+        predictions = [mahotas.label(probabilities > 0.5)[0] for labels, probabilities in slices]
+        ground_truth = [labels for labels, probabilities in slices]
+        tables = [segmentation_table([gt], [pred]) for gt, pred in zip(ground_truth, predictions)]
+        self.assertScoresEqual(contingency_scores(*merge_tables(tables).finalize()),
+                               loop_metrics(ground_truth, predictions))
+
+    def test_quick_Rand(self):
+        for labels, probabilities in synthetic_slices():
+            prediction = mahotas.label(probabilities > 0.3)[0]
+            np.testing.assert_allclose(quick_Rand(labels, prediction),
+                                       loop_metrics([labels], [prediction])['Rand']['F-score'], rtol=1e-9)
+
+
+class ComponentSweepTest(ScoresTestCase):
+    thresholds = np.arange(0, 1, 0.1)
+
+    def assertSweepLikeLabel(self, probabilities, values):
+        seen = set()
+        for index, labels, nr_labels, (table_labels, table_values, table_counts) in component_sweep(probabilities, self.thresholds, values):
+            expected, expected_nr_labels = mahotas.label(probabilities > self.thresholds[index])
+            np.testing.assert_array_equal(labels, expected)
+            self.assertEqual(nr_labels, expected_nr_labels)
+            counted = (expected > 0) & (values >= 0)
+            counts = collections.Counter(zip(expected[counted], values[counted]))
+            self.assertEqual(dict(((label, value), count) for label, value, count
+                                  in zip(table_labels, table_values, table_counts)), dict(counts))
+            seen.add(index)
+        self.assertEqual(seen, set(xrange(len(self.thresholds))))
+
+    def test_labels(self):
+        for labels, probabilities in synthetic_slices():
+            self.assertSweepLikeLabel(probabilities, np.int64(labels) - 1)
+
+    def test_volume(self):
+        slices = synthetic_slices(4)
+        labels = np.array([gt for gt, probabilities in slices])
+        probabilities = np.array([probabilities for gt, probabilities in slices])
+        self.assertSweepLikeLabel(probabilities, np.int64(labels) - 1)
+
+    def test_sweep_metrics(self):
+        labels, probabilities = synthetic_slices(1)[0]
+        results = threshold_sweep_metrics(labels, probabilities, self.thresholds)
+        for threshold, scores in zip(self.thresholds, results):
+            self.assertScoresEqual(scores, loop_metrics([labels], [mahotas.label(probabilities > threshold)[0]]))
+
+
+if __name__=="__main__":
+    unittest.main()
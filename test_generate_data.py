@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import mahotas
+from scipy.ndimage.filters import maximum_filter
+import synthetic_data
+from generate_data import (normalizeImage, saturation_bounds, volume_saturation_bounds, adjust_imprecise_boundaries,
+                           TestImages, convert_test_volume)
+
+# Regression tests of the sampler helpers against the loops they replaced,
+# on small synthetic volumes (see synthetic_data.py).
+#
+#   python -m unittest discover -p 'test_*.py'
+
+
+def synthetic_slices(nr_slices=3, size=96, seed=0):
+    # (gray, thin membranes) of every slice
+    volume = synthetic_data.SyntheticVolume((nr_slices, size, size), cell_size=16, seed=seed)
+    return [volume.slice(z)[::2] for z in xrange(nr_slices)]
+
+
+def sort_normalize(img, saturation_level=0.05):
+    # normalizeImage as it was, with the bounds read from the sorted values
+    sortedValues = np.sort( img.ravel())
+    minVal = np.float32(sortedValues[np.int(len(sortedValues) * (saturation_level / 2))])
+    maxVal = np.float32(sortedValues[np.int(len(sortedValues) * (1 - saturation_level / 2))])
+    normImg = np.float32(img - minVal) * (255 / (maxVal-minVal))
+    normImg[normImg<0] = 0
+    normImg[normImg>255] = 255
+    return (np.float32(normImg) / 255.0)
+
+
+def loop_adjust_imprecise_boundaries(image, label, number_iterations=5):
+    # adjust_imprecise_boundaries as it was, a maximum filter per iteration
+    label = label.copy()
+    label_orig = label.copy()
+    for i in xrange(number_iterations):
+        label = maximum_filter(label, 2)
+        non_valid_label = np.logical_and(label==1, image>0.7)
+        label[non_valid_label] = 0
+    return np.logical_or(label==1, label_orig==1)
+
+
+class NormalizeImageTest(unittest.TestCase):
+
+    def test_slices(self):
+        for gray, membranes in synthetic_slices():
+            # small integer ranges, wide integer ranges and floats
+            for image in (gray, np.uint16(gray) * 257, np.uint32(gray) * 1000, np.float32(gray) / 7):
+                np.testing.assert_array_equal(normalizeImage(image), sort_normalize(image))
+
+    def test_tiles(self):
+        # tiles normalized with the bounds of their slice
+        gray, membranes = synthetic_slices(1)[0]
+        bounds = saturation_bounds(gray)
+        expected = sort_normalize(gray)
+        for rows, cols in ((slice(0, 40), slice(0, 96)), (slice(10, 11), slice(20, 70)), (slice(50, 96), slice(33, 66))):
+            np.testing.assert_array_equal(normalizeImage(gray[rows, cols], bounds=bounds), expected[rows, cols])
+
+    def test_volume_bounds(self):
+        # slices normalized with the bounds of the whole stack
+        stack = np.array([gray for gray, membranes in synthetic_slices()])
+        for volume in (stack, np.uint32(stack) * 1000):
+            bounds = volume_saturation_bounds(iter(volume))
+            expected = sort_normalize(volume)
+            for z in xrange(len(volume)):
+                np.testing.assert_array_equal(normalizeImage(volume[z], bounds=bounds), expected[z])
+
+
+class AdjustImpreciseBoundariesTest(unittest.TestCase):
+
+    def test_slices(self):
+        for gray, membranes in synthetic_slices():
+            image = normalizeImage(gray)
+            label = np.uint8(membranes)
+            for number_iterations in (0, 1, 2, 5, 12):
+                np.testing.assert_array_equal(adjust_imprecise_boundaries(image, label, number_iterations),
+                                              loop_adjust_imprecise_boundaries(image, label, number_iterations))
+
+    def test_uint8(self):
+        # the quantized images of the slice caches
+        for gray, membranes in synthetic_slices():
+            image = np.uint8(np.round(normalizeImage(gray) * 255))
+            np.testing.assert_array_equal(adjust_imprecise_boundaries(image, membranes, 5),
+                                          loop_adjust_imprecise_boundaries(image / 255.0, np.uint8(membranes), 5))
+
+    def test_stack(self):
+        slices = synthetic_slices()
+        images = np.array([normalizeImage(gray) for gray, membranes in slices])
+        labels = np.array([np.uint8(membranes) for gray, membranes in slices])
+        expected = [loop_adjust_imprecise_boundaries(image, label, 5) for image, label in zip(images, labels)]
+        np.testing.assert_array_equal(adjust_imprecise_boundaries(images, labels, 5), expected)
+
+
+class TestImagesTest(unittest.TestCase):
+    # tiles against padding whole normalized images like the unet loops did
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), '')
+        os.makedirs(self.path + 'gray_images')
+        for z, (gray, membranes) in enumerate(synthetic_slices()):
+            mahotas.imsave(self.path + 'gray_images/' + str(z).zfill(4) + '.tif', gray)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def assertTilesLikePadding(self, normalize_per_volume, patchSize=40, patchSize_out=24):
+        test_images = TestImages(self.path, normalize_per_volume)
+        stack = np.array([mahotas.imread(self.path + 'gray_images/' + name) for name in sorted(os.listdir(self.path + 'gray_images'))])
+        padding_ul = int(np.ceil((patchSize - patchSize_out)/2.0))
+        for z, image in enumerate(stack):
+            if normalize_per_volume:
+                image = sort_normalize(stack)[z]
+            else:
+                image = sort_normalize(image)
+            paddedImage = np.pad(image, patchSize, mode='reflect')[patchSize - padding_ul:, patchSize - padding_ul:]
+            for row in xrange(0, image.shape[0], patchSize_out):
+                for col in xrange(0, image.shape[1], patchSize_out):
+                    np.testing.assert_array_equal(test_images.tile(z, row - padding_ul, col - padding_ul, patchSize),
+                                                  paddedImage[row:row+patchSize, col:col+patchSize])
+        layers = test_images.tile([0, 1, 1], -padding_ul, 50, patchSize)
+        np.testing.assert_array_equal(layers[1], test_images.tile(1, -padding_ul, 50, patchSize))
+
+    def test_tif(self):
+        self.assertTilesLikePadding(False)
+        self.assertTilesLikePadding(True)
+        # tiles larger than the image are mirrored more than once
+        self.assertTilesLikePadding(False, 200, 150)
+
+    def test_chunked_volume(self):
+        convert_test_volume(self.path, chunk_shape=(1, 32, 32))
+        self.assertTilesLikePadding(False)
+        self.assertTilesLikePadding(True)
+        self.assertTilesLikePadding(False, 200, 150)
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import glob
+import json
+import time
+import atexit
+import threading
+
+# recorded trace events while tracing is enabled, None when it is disabled
+events = None
+# file the trace is written to at exit by the process trace_owner
+trace_path = None
+trace_owner = None
+
+
+class NullSpan(object):
+    # returned by span() while tracing is disabled, does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Span(object):
+    '''One timed block, recorded as a complete ('X') trace event on exit.
+
+    Spans opened inside other spans end up nested below them on the
+    timeline, nothing has to be passed around for that.
+
+    '''
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.time()
+        if events is not None:
+            event = {'name': self.name, 'ph': 'X', 'ts': self.start*1e6, 'dur': (end - self.start)*1e6,
+                     'pid': os.getpid(), 'tid': threading.current_thread().ident}
+            if self.args:
+                event['args'] = self.args
+            events.append(event)
+        return False
+
+
+def span(name, **args):
+    '''with span('read', file=name): ... times the block while tracing is
+    enabled. Disabled, it only costs the call and returns a shared no-op
+    context manager. args are shown with the event in the trace viewer.
+
+    '''
+    if events is None:
+        return null_span
+    return Span(name, args)
+
+
+def traced(name):
+    # decorator version of span for whole functions
+    def decorate(function):
+        def traced_function(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        traced_function.__name__ = function.__name__
+        traced_function.__doc__ = function.__doc__
+        return traced_function
+    return decorate
+
+
+def is_enabled():
+    return events is not None
+
+
+def enable(path=None):
+    '''Starts recording spans. With a path, the trace is written there when
+    the process exits.
+
+    Forked worker processes (e.g. of a ParallelSampler) keep recording into
+    their own copy. They write it next to the trace with save_worker() when
+    they stop, and save() merges these files into the trace.
+
+    '''
+    global events, trace_path, trace_owner
+    if events is None:
+        events = []
+    if path is not None:
+        if trace_path is None:
+            atexit.register(save_at_exit)
+        trace_path = path
+        trace_owner = os.getpid()
+        # left over from an earlier run
+        for file_name in worker_files(path):
+            os.remove(file_name)
+
+
+def save_at_exit():
+    if trace_path is not None and os.getpid() == trace_owner:
+        save(trace_path)
+        for file_name in worker_files(trace_path):
+            os.remove(file_name)
+
+
+def worker_files(path):
+    return glob.glob(path + '.worker*')
+
+
+def save_worker():
+    '''Writes the spans a forked worker process recorded to path.worker<pid>
+    for save() in the main process. Workers call it when they stop, atexit
+    handlers do not run in multiprocessing workers.
+
+    '''
+    if events is None or trace_path is None or os.getpid() == trace_owner:
+        return
+    pid = os.getpid()
+    with open('%s.worker%d' % (trace_path, pid), 'w') as trace_file:
+        json.dump([event for event in events if event['pid'] == pid], trace_file)
+
+
+def disable():
+    global events
+    events = None
+
+
+def save(path):
+    '''Writes the spans recorded so far as Chrome trace-event JSON, which
+    chrome://tracing or https://ui.perfetto.dev show as a timeline. Spans
+    of stopped worker processes (see save_worker) are merged in.
+
+    '''
+    trace_events = list(events or [])
+    for file_name in sorted(worker_files(path)):
+        with open(file_name) as worker_file:
+            trace_events.extend(json.load(worker_file))
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+# TRACE_FILE=run.json traces the whole run of any script into run.json
+if os.environ.get('TRACE_FILE'):
+    enable(os.environ['TRACE_FILE'])
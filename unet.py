@@ -10,7 +10,8 @@ from keras import backend as K
 from keras.optimizers import SGD
 from keras.regularizers import l2
 from generate_data import *
-import multiprocessing
+from minibatches import minibatch_generator
+from tracing import span
 import sys
 import matplotlib
 import matplotlib.pyplot as plt
@@ -19,6 +20,7 @@ import matplotlib.pyplot as plt
 import theano
 import theano.tensor as T
 from evaluation import Rand_membrane_prob
+from ground_truth_index import GroundTruthIndex
 from theano.tensor.shared_randomstreams import RandomStreams
 
 rng = np.random.RandomState(7)
@@ -42,6 +44,11 @@ doBatchNormAll = False
 doFineTune = True
 
 purpose = 'train'
+sampling_workers = 2
+# draw patches where the loss was high (see ImportanceMap)
+hard_example_mining = False
+# normalize all test slices with saturation bounds of the whole volume
+normalize_per_volume = False
 initialization = 'glorot_uniform'
 filename = 'unet_sampling_best_fineTuned'
 print "filename: ", filename
@@ -232,28 +239,34 @@ if doTrain:
     data_x_val = np.reshape(data_x_val, [-1, 1, patchSize, patchSize])
     data_y_val = data_val[1].astype(np.float32)
     data_label_val = data_val[2]
-
-    # start pool for data
-    print "Starting worker."
-    pool = multiprocessing.Pool(processes=1)
-    futureData = pool.apply_async(stupid_map_wrapper, [[generate_experiment_data_patch_prediction,purpose, train_samples, patchSize, patchSize_out]])
+    # the validation labels are the same every epoch
+    gt_val = [GroundTruthIndex(np.reshape(labels, (patchSize_out,patchSize_out))) for labels in data_label_val]
+
+    # start workers for data
+    print "Starting workers."
+    importance = None
+    if hard_example_mining:
+        # created before the workers start, so they share its weights
+        sampler = get_resident_sampler(PatchSampler, purpose, 'train*.tif')
+        importance = ImportanceMap(len(sampler.img_files_gray), sampler.slice_shape)
+    batches = minibatch_generator(generate_experiment_data_patch_prediction, purpose, 1, [patchSize, patchSize_out],
+                                  input_shape=(1, patchSize, patchSize), nr_workers=sampling_workers, seed=7,
+                                  importance=importance)
     
     best_val_loss_so_far = 0
     
     patience_counter = 0
     for epoch in xrange(10000000):
-        print "Waiting for data."
-        data = futureData.get()
-        
-        data_x = data[0].astype(np.float32)
-        data_x = np.reshape(data_x, [-1, 1, patchSize, patchSize])
-        data_y = data[1].astype(np.float32)
-        
-        print "got new data"
-        futureData = pool.apply_async(stupid_map_wrapper, [[generate_experiment_data_patch_prediction,purpose, train_samples, patchSize, patchSize_out]])
- 
         print "current learning rate: ", model.optimizer.lr.get_value()
-        model.fit(data_x, data_y, batch_size=1, nb_epoch=1)
+        # minibatches are sampled while the network trains on the previous ones
+        if importance is None:
+            model.fit_generator(batches, samples_per_epoch=train_samples, nb_epoch=1)
+        else:
+            # the loss of every minibatch goes back into the importance map
+            for sample in xrange(train_samples):
+                inputs, targets, locations = next(batches)
+                loss = model.train_on_batch(inputs, targets)
+                importance.update(locations, loss)
 
 
         im_pred = 1-model.predict(x=data_x_val, batch_size = 1)
@@ -261,8 +274,7 @@ if doTrain:
         mean_val_rand = 0
         for val_ind in xrange(val_samples):
             im_pred_single = np.reshape(im_pred[val_ind,:], (patchSize_out,patchSize_out))
-            im_gt = np.reshape(data_label_val[val_ind], (patchSize_out,patchSize_out))
-            validation_rand = Rand_membrane_prob(im_pred_single, im_gt)
+            validation_rand = Rand_membrane_prob(im_pred_single, gt_val[val_ind])
             mean_val_rand += validation_rand
         mean_val_rand /= np.double(val_samples)
         print "validation RAND ", mean_val_rand
@@ -327,58 +339,51 @@ else:
         sgd = SGD(lr=0.01, decay=0, momentum=0.0, nesterov=False)
         model.compile(loss='categorical_crossentropy', optimizer=sgd)
         
-        img_search_string = pathPrefix + 'gray_images/*.tif'
-        img_files = sorted( glob.glob( img_search_string ) )
+        # gray_images/*.tif or the converted chunked volume (see
+        # convert_test_volume), normalized per slice or per volume
+        test_images = TestImages(pathPrefix, normalize_per_volume)
         
-        for img_index in xrange(np.shape(img_files)[0]):
-            print img_files[img_index]
-            image = mahotas.imread(img_files[img_index])
-            image = normalizeImage(image) 
-            image = image - 0.5
+        for img_index in xrange(len(test_images.names)):
+            print test_images.names[img_index]
             
-            probImage = np.zeros(image.shape)
+            probImage = np.zeros(test_images.shape)
             # count compilation time to init
             row = 0
             col = 0
-            patch = image[row:row+patchSize,col:col+patchSize]
+            patch = test_images.tile(img_index, row, col, patchSize) - 0.5
             data = np.reshape(patch, (1,1,patchSize,patchSize))
             probs = model.predict(x=data, batch_size=1)
             
             init_time = time.clock()
             #print "Initialization took: ", init_time - start_time
             
-            image_orig = image.copy()
-            for rotation in range(1):
-                image = np.rot90(image_orig, rotation)
-                # pad the image
-                padding_ul = int(np.ceil((patchSize - patchSize_out)/2.0))
-                # need large padding for lower right corner
-                paddedImage = np.pad(image, patchSize, mode='reflect')
-                needed_ul_padding = patchSize - padding_ul
-                paddedImage = paddedImage[needed_ul_padding:, needed_ul_padding:]
-                
-                probImage_tmp = np.zeros(image.shape)
-                for row in xrange(0,image.shape[0],patchSize_out):
-                    for col in xrange(0,image.shape[1],patchSize_out):
-                        patch = paddedImage[row:row+patchSize,col:col+patchSize]
-                        data = np.reshape(patch, (1,1,patchSize,patchSize))
+            # tiles are read from the image padded by reflection, the
+            # padding leaves padding_ul pixels above and left of it
+            padding_ul = int(np.ceil((patchSize - patchSize_out)/2.0))
+            for row in xrange(0,probImage.shape[0],patchSize_out):
+                for col in xrange(0,probImage.shape[1],patchSize_out):
+                    with span('pad'):
+                        patch = test_images.tile(img_index, row - padding_ul, col - padding_ul, patchSize) - 0.5
+                    data = np.reshape(patch, (1,1,patchSize,patchSize))
+                    with span('predict'):
                         probs = 1-model.predict(x=data, batch_size = 1)
-                        probs = np.reshape(probs, (patchSize_out,patchSize_out))
+                    probs = np.reshape(probs, (patchSize_out,patchSize_out))
+                    
+                    row_end = patchSize_out
+                    if row+patchSize_out > probImage.shape[0]:
+                        row_end = probImage.shape[0]-row
+                    col_end = patchSize_out
+                    if col+patchSize_out > probImage.shape[1]:
+                        col_end = probImage.shape[1]-col
                         
-                        row_end = patchSize_out
-                        if row+patchSize_out > probImage.shape[0]:
-                            row_end = probImage.shape[0]-row
-                        col_end = patchSize_out
-                        if col+patchSize_out > probImage.shape[1]:
-                            col_end = probImage.shape[1]-col
-                            
-                        probImage_tmp[row:row+row_end,col:col+col_end] = probs[:row_end,:col_end]
-                probImage += np.rot90(probImage_tmp, 4-rotation)
+                    with span('stitch'):
+                        probImage[row:row+row_end,col:col+col_end] = probs[:row_end,:col_end]
                 
             probImage = probImage / 1.0
             
             print pathPrefix+'boundaryProbabilities/'+model_name+'/'+str(img_index).zfill(4)+'.tif'
-            mahotas.imsave(pathPrefix+'boundaryProbabilities/'+model_name+'/'+str(img_index).zfill(4)+'.tif', np.uint8(probImage*255))
+            with span('write'):
+                mahotas.imsave(pathPrefix+'boundaryProbabilities/'+model_name+'/'+str(img_index).zfill(4)+'.tif', np.uint8(probImage*255))
             
             end_time = time.clock()
             print "Prediction took: ", end_time - init_time
@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+import collections
+import numpy as np
+
+# bump whenever the layout or content of cached stacks changes
+CACHE_VERSION = 2
+
+# cached stacks go here unless VOLUME_CACHE_DIR is set
+default_cache_dir = './volume_cache/'
+
+
+# slices a lazy stack keeps in memory unless SLICE_CACHE_SIZE is set, the
+# current slice plus the next one; SliceStore.layers grows it to the number
+# of layers plus one
+default_slice_cache_size = 2
+
+
+def slice_cache_size():
+    # number of slices a lazy stack keeps in memory, the default if
+    # SLICE_CACHE_SIZE is empty or not a number
+    try:
+        return int(os.environ.get('SLICE_CACHE_SIZE', default_slice_cache_size))
+    except ValueError:
+        return default_slice_cache_size
+
+
+def cache_dir():
+    path = os.environ.get('VOLUME_CACHE_DIR', default_cache_dir)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def file_signature(file_names):
+    # any change of a source file (path, size or mtime) invalidates the cache entry
+    signature = []
+    for file_name in file_names:
+        stat = os.stat(file_name)
+        signature.append([os.path.abspath(file_name), stat.st_size, int(stat.st_mtime)])
+    return signature
+
+
+def cache_key(name, file_names, params=None):
+    description = json.dumps([CACHE_VERSION, name, params, file_signature(file_names)], sort_keys=True)
+    return hashlib.sha1(description).hexdigest()
+
+
+def smallest_integer_type(image):
+    # smallest integer type holding every value of image (and 0)
+    return np.promote_types(np.min_scalar_type(min(image.min(), 0)), np.min_scalar_type(max(image.max(), 0)))
+
+
+def cached_slice(name, file_name, read_function, params=None, dtype=None, sources=()):
+    # an image decoded and preprocessed once, stored in the cache directory
+    # under name and a key of the file and params, memory mapped read-only
+    # when it is loaded. sources are further files read_function reads,
+    # their changes invalidate the image as well
+    if params is None:
+        params = {}
+    path = os.path.join(cache_dir(), name + '-' + cache_key(name, [file_name] + list(sources), params) + '.npy')
+
+    if not os.path.exists(path):
+        image = read_function(file_name, **params)
+        if dtype == 'smallest':
+            dtype = smallest_integer_type(image)
+        if dtype is not None:
+            image = image.astype(dtype)
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as slice_file:
+            np.save(slice_file, image)
+        os.rename(tmp_path, path)
+
+    return np.load(path, mmap_mode='r')
+
+
+class SliceStore(object):
+    '''Slices of a volume that are loaded on first access.
+
+    load_slice(index) returns slice index, the cache_size most recently used
+    slices are kept in memory (all of them for cache_size=None), so memory is
+    bounded by the cache size instead of the volume size. layers() raises
+    the bound to the number of layers plus one, so a window of neighbouring
+    slices moving through the volume is read only once. Returned slices are
+    read-only, every process (e.g. each sampling worker) has its own cache.
+
+    '''
+    def __init__(self, load_slice, nr_slices, cache_size=None):
+        self.load_slice = load_slice
+        self.nr_slices = nr_slices
+        self.cache_size = cache_size
+        self.slices = collections.OrderedDict()
+
+    def __len__(self):
+        return self.nr_slices
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index in self.slices:
+            # move to the most recently used end
+            image = self.slices.pop(index)
+        else:
+            image = self.load_slice(index)
+            image.flags.writeable = False
+        self.slices[index] = image
+        if self.cache_size is not None and len(self.slices) > self.cache_size:
+            self.slices.popitem(last=False)
+        return image
+
+    def layers(self, indices):
+        # the given slices, cut like one (len(indices), rows, cols) block
+        if self.cache_size is not None:
+            self.cache_size = max(self.cache_size, len(indices) + 1)
+        return LayerWindow([self[index] for index in indices])
+
+
+class LayerWindow(object):
+    '''Several slices cut like one (layers, rows, cols) array.
+
+    window[rows, cols] copies only that window of every slice into a
+    C-contiguous (layers, rows, cols) block, the slices themselves are
+    never stacked.
+
+    '''
+    def __init__(self, slices):
+        self.slices = slices
+        self.shape = (len(slices),) + slices[0].shape
+
+    def __getitem__(self, key):
+        rows, cols = key[-2:]
+        return np.array([image[rows, cols] for image in self.slices])
+
+
+def lazy_stack(name, file_names, read_function, params=None, dtype=None, cache_size=None):
+    '''SliceStore of the images in file_names, every image is decoded on its
+    first access and cached on disk on its own (see cached_slice).
+    cache_size defaults to slice_cache_size().
+
+    '''
+    if cache_size is None:
+        cache_size = slice_cache_size()
+    return SliceStore(lambda index: cached_slice(name, file_names[index], read_function, params, dtype),
+                      len(file_names), cache_size)